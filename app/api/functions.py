@@ -1,35 +1,169 @@
-from fastapi import APIRouter, Depends, status, Request, HTTPException
+import json
+from collections.abc import AsyncIterator
+
+from fastapi import APIRouter, BackgroundTasks, Depends, status, Request, Response, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.database import get_db, get_warehouse, DBManager
+from app.database import get_db, get_warehouse, warehouse_engines, DBManager
 from app.services.auth import AuthBearer
 
-from app.services.custom_function_handler import CustomFunctionHandler, build_schemas
+from app.services.custom_function_handler import CustomFunctionHandler
+from app.services.cache import cache_stats
+from app.services.cache_lock import lock_stats
+from app.services.cache_warmer import warm_batch, warm_tenant_db
+from app.config import settings as global_settings
+from app.services.closed_periods import reopen_periods, set_closed_through
+from app.services.data_version import bump_data_version
+from app.exceptions import ForbiddenHTTPException, NotFoundHTTPException
+from app.services.scheduler import LANES, get_tenant_scheduler
+from app.services.singleflight import warehouse_flights
+from app.services.tenant_context import get_tenant_context, invalidate_tenant_context
+from app.utils.logging import AppLogger
 from dataclasses import asdict
 
+logger = AppLogger().get_logger()
+
 router = APIRouter(prefix="/v1/functions")
 
-from app.schemas.batches import BatchIn, BatchOut
+from app.schemas.batches import BatchIn, BatchOut, ClosedThroughIn, SyncIn, WarmIn
 from app.schemas.user import User
 
 auth_bearer = AuthBearer()
 
 
+async def ndjson_results(q: CustomFunctionHandler) -> AsyncIterator[str]:
+    """Streams each batch result as one NDJSON line as soon as it completes."""
+    try:
+        async for index, result in q.iter_results():
+            yield json.dumps(jsonable_encoder({'index': index, **asdict(result)})) + '\n'
+    except Exception as e:
+        logger.exception('streaming batch results failed')
+        yield json.dumps({'index': None, 'status': 'error', 'type': 'scalar', 'value': str(e)}) + '\n'
+
+
 @router.post("/", status_code=status.HTTP_200_OK, response_model=BatchOut)
 async def xqf_batch(payload: BatchIn,
                     request: Request,
+                    response: Response,
                     token: User = Depends(auth_bearer),
                     db_session: AsyncSession = Depends(get_db),
                     db_manager: DBManager = Depends(get_warehouse),
                     ):
     try:
-        async with db_session.begin():
-            schemas = await build_schemas(db_session, request.state.user['tenant_id'])
-            q = CustomFunctionHandler(db_manager, payload.platform, payload.request_batch, schemas,
-                                      request.state.user['tenant_db'], request.app.state.redis)
-            results = await q.execute()
-            results = [asdict(result) for result in results]
+        context = await get_tenant_context(db_session, request.app.state.redis, request.state.user['tenant_id'],
+                                           request.state.user['tenant_db'])
+        q = CustomFunctionHandler(db_manager, payload.platform, payload.request_batch, context.schemas,
+                                  context.tenant_db, request.app.state.redis,
+                                  pipelined=payload.pipelined, timeout=payload.timeout,
+                                  cache_redis=request.app.state.cache_redis)
+        if payload.stream:
+            return StreamingResponse(ndjson_results(q), media_type='application/x-ndjson')
+        results = await q.execute()
+        results = [asdict(result) for result in results]
+        response.headers['X-Queue-Wait'] = f"{q.scheduler.queue_wait:.3f}"
 
         return BatchOut(response_batch=results)
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/stats", status_code=status.HTTP_200_OK)
+async def xqf_stats(request: Request, token: User = Depends(auth_bearer)):
+    """
+    Execution counters of this worker: the lanes of the caller's tenant, plus the engine, singleflight and cache
+    counters, which span every tenant and are therefore only shown to superusers.
+    """
+    if not request.state.user.get('is_superuser'):
+        raise ForbiddenHTTPException('worker stats are only available to superusers')
+    tenant_db = request.state.user['tenant_db']
+    return {
+        'scheduler': {lane: get_tenant_scheduler(tenant_db, lane).stats() for lane in LANES},
+        'singleflight': warehouse_flights.stats(),
+        'cache_lock': lock_stats,
+        'cache': cache_stats(),
+        'engines': warehouse_engines.stats(),
+    }
+
+
+async def requested_schemas(db_session: AsyncSession, request: Request, schema_name: str | None) -> dict:
+    """The tenant's schemas, or only schema_name when given."""
+    context = await get_tenant_context(db_session, request.app.state.redis, request.state.user['tenant_id'],
+                                       request.state.user['tenant_db'])
+    schemas = context.schemas
+    if schema_name is None:
+        return schemas
+    if schema_name not in schemas:
+        raise NotFoundHTTPException(f"Schema {schema_name} not found")
+    return {schema_name: schemas[schema_name]}
+
+
+@router.post("/sync-complete", status_code=status.HTTP_200_OK)
+async def xqf_sync_complete(payload: SyncIn,
+                            request: Request,
+                            token: User = Depends(auth_bearer),
+                            db_session: AsyncSession = Depends(get_db),
+                            ):
+    """Bumps the data version of synced schemas, so cached results computed before the sync stop matching."""
+    schemas = await requested_schemas(db_session, request, payload.schema_name)
+    tenant_db = request.state.user['tenant_db']
+    versions = {}
+    for schema in schemas.values():
+        # handler functions read the dbt models, get_table reads the raw connector schema
+        for schema_ref in (schema.build_dbt_schema(), schema.build_schema()):
+            versions[schema_ref] = await bump_data_version(request.app.state.redis, tenant_db, schema_ref)
+    return {'versions': versions}
+
+
+@router.post("/closed-through", status_code=status.HTTP_200_OK)
+async def xqf_closed_through(payload: ClosedThroughIn,
+                             request: Request,
+                             token: User = Depends(auth_bearer),
+                             db_session: AsyncSession = Depends(get_db),
+                             ):
+    """Sets the tenant's books-closed date for a schema, overriding the lock date read from the source system."""
+    schemas = await requested_schemas(db_session, request, payload.schema_name)
+    schema_ref = schemas[payload.schema_name].build_dbt_schema()
+    await set_closed_through(request.app.state.redis, request.state.user['tenant_db'], schema_ref,
+                             payload.closed_through)
+    return {'closed_through': payload.closed_through}
+
+
+@router.post("/reopen", status_code=status.HTTP_200_OK)
+async def xqf_reopen(payload: SyncIn,
+                     request: Request,
+                     token: User = Depends(auth_bearer),
+                     db_session: AsyncSession = Depends(get_db),
+                     ):
+    """Drops the closed-period results of reopened schemas; they are recomputed on their next request."""
+    schemas = await requested_schemas(db_session, request, payload.schema_name)
+    tenant_db = request.state.user['tenant_db']
+    generations = {}
+    for schema in schemas.values():
+        schema_ref = schema.build_dbt_schema()
+        generations[schema_ref] = await reopen_periods(request.app.state.redis, tenant_db, schema_ref)
+    return {'generations': generations}
+
+
+@router.post("/warm", status_code=status.HTTP_202_ACCEPTED)
+async def xqf_warm(payload: WarmIn,
+                   request: Request,
+                   background_tasks: BackgroundTasks,
+                   token: User = Depends(auth_bearer),
+                   db_session: AsyncSession = Depends(get_db),
+                   ):
+    """Precomputes the month-end statements of the tenant's active schemas into the cache after a sync."""
+    schemas = await requested_schemas(db_session, request, payload.schema_name)
+    months = payload.months or global_settings.warm_months
+    # runs after the response is sent, on an engine lease of its own rather than the request's
+    background_tasks.add_task(warm_tenant_db, request.state.user['tenant_db'], schemas,
+                              request.app.state.redis, request.app.state.cache_redis, months)
+    return {'queued': len(warm_batch(schemas, months))}
+
+
+@router.post("/reload-context", status_code=status.HTTP_200_OK)
+async def xqf_reload_context(request: Request, token: User = Depends(auth_bearer)):
+    """Drops the tenant's cached schema list on every worker; call it after schemas were added or changed."""
+    generation = await invalidate_tenant_context(request.app.state.redis, request.state.user['tenant_id'])
+    return {'generation': generation}
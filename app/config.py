@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 from pydantic import PostgresDsn, RedisDsn
 from pydantic_settings import BaseSettings
@@ -8,6 +9,58 @@ class Settings(BaseSettings):
     asyncpg_url: PostgresDsn = os.getenv("SQL_URL")
     redis_url: RedisDsn = os.getenv("REDIS_URL")
     warehouse_url: PostgresDsn = os.getenv("WSQL_URL")
+    # per-tenant warehouse engine pool; pre-ping is always on
+    warehouse_pool_size: int = 5
+    warehouse_max_overflow: int = 10
+    warehouse_pool_timeout: float = 30.0
+    warehouse_pool_recycle: int = 30 * 60
+    warehouse_echo: bool = False
+    # seconds any warehouse statement may run on the server; batch items are capped at their deadline instead
+    warehouse_statement_timeout: float = 10 * 60
+    # seconds a connection's statement_timeout may run past an item's deadline before it is set again;
+    # setting it exactly for every item would cost a round trip per statement
+    warehouse_statement_timeout_slack: float = 1.0
+    # prepared statements asyncpg keeps per warehouse connection: the SQL catalog for a few schemas, plus filter variants
+    warehouse_prepared_statement_cache_size: int = 256
+    # cap on warehouse connections checked out at once across all tenants in one worker;
+    # idle tenant engines are kept up to the number of full pools it fits
+    warehouse_max_connections: int = 300
+    # seconds an engine no request is using is kept before it is disposed
+    warehouse_engine_idle_timeout: float = 10 * 60
+    # seconds a warehouse call waits for a connection when the worker is at warehouse_max_connections
+    warehouse_connection_wait_timeout: float = 30.0
+    # max warehouse calls in flight per lane for one request batch
+    batch_concurrency: int = 8
+    # max warehouse calls in flight for one tenant across all requests, per lane;
+    # together they stay within the default engine pool (5 + 10 overflow)
+    scalar_lane_concurrency: int = 10
+    bulk_lane_concurrency: int = 4
+    # seconds a request batch may take; items still running after that come back as errors
+    batch_timeout: float = 60.0
+    # seconds warehouse results stay in Redis; keys carry the schema data version, so this is only a safety net
+    cache_ttl: int = 24 * 60 * 60
+    # seconds a cached result counts as fresh; after that it is still served while a background refresh runs
+    cache_soft_ttl: int = 5 * 60
+    # seconds a worker reuses a tenant's schemas loaded from the app database
+    tenant_context_ttl: float = 300.0
+    # seconds a worker reuses a schema's data version before asking Redis again
+    data_version_ttl: float = 15.0
+    # in-process cache in front of Redis: size cap in bytes, and lifetime of copies taken from Redis
+    local_cache_bytes: int = 64 * 1024 * 1024
+    local_cache_ttl: float = 30.0
+    # cached values at least this many bytes long are stored zlib-compressed in Redis
+    cache_compress_min_bytes: int = 16 * 1024
+    # seconds a worker holds the Redis lease while filling a cache miss / others wait for it to land
+    cache_lock_lease: float = 60.0
+    cache_lock_wait: float = 10.0
+    # seconds results that only cover closed periods stay cached; they are dropped by a reopen, not by syncs
+    closed_period_cache_ttl: int = 365 * 24 * 60 * 60
+    # Sage Intacct company_pref property holding the books-closed-through date; unset, Sage tenants configure it
+    sage_lock_date_property: Optional[str] = None
+    # post-sync cache warming: months of statements to precompute, warehouse calls at once, time budget in seconds
+    warm_months: int = 3
+    warm_concurrency: int = 2
+    warm_timeout: float = 600.0
 
 
 settings = Settings()
@@ -1,19 +1,22 @@
-from asyncio import current_task, TaskGroup
-from collections.abc import AsyncGenerator
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+import asyncio
+import time
+from asyncio import TaskGroup, Lock
+from collections import OrderedDict
+from collections.abc import AsyncGenerator, AsyncIterator
+from contextlib import asynccontextmanager
+from sqlalchemy import Executable, Result, Select, event, func, select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from fastapi import Request
 from app.config import settings as global_settings
 from app.utils.logging import AppLogger
-from typing import Dict
+from typing import Callable, Dict
 from typing import Iterable
-from sqlalchemy.ext.asyncio import async_scoped_session
 
 logger = AppLogger().get_logger()
 
 ##############################################################################################################
 # Warehouse database
-warehouse_cache: Dict[str, any] = {}
 
 
 async def _close_sessions(db_sessions: Iterable[AsyncSession]):
@@ -22,47 +25,352 @@ async def _close_sessions(db_sessions: Iterable[AsyncSession]):
             task_group.create_task(db_session.close())
 
 
-def _get_current_task_id() -> int:
-    return id(current_task())
+def schema_options(schema_ref: str) -> dict:
+    """
+    Execution options that render the warehouse Table models qualified with schema_ref, so no statement needs a
+    search_path round trip before it. The name is folded to lower case, as search_path did with unquoted names.
+    """
+    return {"schema_translate_map": {None: schema_ref.lower()}}
+
+
+def session_settings(statement_timeout: int, local: bool = True) -> Select:
+    """
+    Caps each statement of the current transaction at statement_timeout milliseconds on the server;
+    with local=False, each statement the connection runs until it is set again.
+    """
+    return select(func.set_config("statement_timeout", f"{max(statement_timeout, 1)}ms", local))
+
+
+def _backstop_timeout() -> int:
+    return int(global_settings.warehouse_statement_timeout * 1000)
+
+
+async def apply_statement_timeout(session: AsyncSession, statement_timeout: int | None):
+    """
+    Caps the statements the session's connection runs next at statement_timeout milliseconds on the server,
+    or at the warehouse_statement_timeout backstop when None. Warehouse connections run in autocommit, so the
+    cap stays on the connection; it is only sent again when the current one is tighter, or looser by more than
+    warehouse_statement_timeout_slack, so most statements still go out on their own.
+    """
+    wanted = _backstop_timeout() if statement_timeout is None else max(statement_timeout, 1)
+    connection = await session.connection()
+    current = connection.info.get('statement_timeout')
+    if current is not None and wanted <= current <= wanted + global_settings.warehouse_statement_timeout_slack * 1000:
+        return
+    await connection.execute(session_settings(wanted, local=False))
+    connection.info['statement_timeout'] = wanted
+
+
+def _started_with_backstop(dbapi_connection, connection_record):
+    connection_record.info['statement_timeout'] = _backstop_timeout()
+
+
+class SnapshotSession:
+    """
+    Runs a batch's statements for one schema back-to-back on a single connection,
+    inside one read-only REPEATABLE READ transaction, so every cell of a recalc reads the same snapshot.
+    asyncpg keeps its prepared statement cache per connection, so repeated statements skip parse and plan.
+    """
+
+    def __init__(self, async_session_factory, schema_ref: str):
+        self.async_session_factory = async_session_factory
+        self.schema_ref = schema_ref
+        self.session: AsyncSession | None = None
+        self._lock = Lock()
+
+    async def _open(self, statement_timeout: int | None) -> AsyncSession:
+        session = self.async_session_factory()
+        try:
+            await session.connection(execution_options={
+                "isolation_level": "REPEATABLE READ",
+                "postgresql_readonly": True,
+            })
+            if statement_timeout is not None:
+                await session.execute(session_settings(statement_timeout))
+        except BaseException:
+            await session.close()
+            raise
+        return session
+
+    async def execute(self, stmt: Executable, statement_timeout: int | None = None) -> Result:
+        """Runs stmt on the snapshot; statement_timeout (ms) applies from the moment the snapshot is opened."""
+        async with self._lock:
+            if self.session is None:
+                self.session = await self._open(statement_timeout)
+            try:
+                return await self.session.execute(stmt, execution_options=schema_options(self.schema_ref))
+            except BaseException as e:
+                # a failed statement aborts the transaction, so it is rolled back and the next one starts a fresh
+                # snapshot; a cancelled one may still be running, so its connection is dropped instead of reused
+                await self.close(invalidate=isinstance(e, asyncio.CancelledError))
+                raise
+
+    async def close(self, invalidate: bool = False):
+        if self.session is not None:
+            session, self.session = self.session, None
+            await (session.invalidate() if invalidate else session.close())
 
 
 class DBManager:
-    def __init__(self, async_session_factory):
-        self.scoped_session_factory = async_scoped_session(
-            async_session_factory,
-            scopefunc=_get_current_task_id
-        )
+    """
+    Per-request handle on a tenant's warehouse: the engine's shared session factory plus the snapshot sessions
+    this request opened, one per schema, created on first use. Plain statements open a session of their own
+    for the duration of a scheduler slot, so they never hold a connection past it.
+    """
+
+    def __init__(self, async_session_factory, engine_key: str | None = None):
+        self.async_session_factory = async_session_factory
+        # registry key of the engine this manager leases, released by close_warehouse
+        self.engine_key = engine_key
+        self.snapshot_sessions: Dict[str, SnapshotSession] = {}
+
+    def get_snapshot_session(self, schema_ref: str) -> SnapshotSession:
+        if schema_ref not in self.snapshot_sessions:
+            self.snapshot_sessions[schema_ref] = SnapshotSession(self.async_session_factory, schema_ref)
+        return self.snapshot_sessions[schema_ref]
+
+
+def create_warehouse_engine(db_string: str) -> AsyncEngine:
+    """
+    Warehouse statements are plain reads, so connections run in autocommit and a query is a single round trip,
+    without a BEGIN ahead of it; snapshot sessions switch their connection to REPEATABLE READ themselves.
+    Connections start out with the statement_timeout backstop; apply_statement_timeout tightens it to the
+    deadline of the item about to run.
+    Each connection keeps the catalog statements it has run prepared, so repeats skip parse and plan.
+    """
+    engine = create_async_engine(
+        db_string,
+        future=True,
+        echo=global_settings.warehouse_echo,
+        isolation_level="AUTOCOMMIT",
+        connect_args={
+            "server_settings": {
+                "statement_timeout": f"{_backstop_timeout()}ms",
+            },
+            "prepared_statement_cache_size": global_settings.warehouse_prepared_statement_cache_size,
+        },
+        pool_size=global_settings.warehouse_pool_size,
+        max_overflow=global_settings.warehouse_max_overflow,
+        pool_timeout=global_settings.warehouse_pool_timeout,
+        pool_recycle=global_settings.warehouse_pool_recycle,
+        pool_pre_ping=True,
+    )
+    event.listen(engine.sync_engine, 'connect', _started_with_backstop)
+    return engine
+
+
+class ConnectionPermits:
+    """The warehouse connections one worker may have checked out at once, shared by every tenant engine."""
+
+    def __init__(self, limit: int, wait_timeout: float | None = None):
+        self.limit = max(limit, 1)
+        self.wait_timeout = wait_timeout
+        self.in_use = 0
+        self._free = asyncio.Semaphore(self.limit)
+
+    async def acquire(self):
+        """Waits for a permit; raises TimeoutError when none came free within wait_timeout seconds."""
+        try:
+            await asyncio.wait_for(self._free.acquire(), self.wait_timeout)
+        except TimeoutError:
+            raise TimeoutError(f'no warehouse connection came free within {self.wait_timeout:g}s') from None
+        self.in_use += 1
+
+    def release(self):
+        self.in_use -= 1
+        self._free.release()
+
+
+class WarehouseSession(AsyncSession):
+    """
+    Session of a registry engine. It holds one of the worker's connection permits from its first statement
+    until it is closed, which covers the time it can have a connection checked out.
+    """
+
+    def __init__(self, *args, permits: ConnectionPermits, **kw):
+        super().__init__(*args, **kw)
+        self._permits = permits
+        self._holds_permit = False
+
+    async def _take_permit(self):
+        if not self._holds_permit:
+            await self._permits.acquire()
+            self._holds_permit = True
 
-    def get_session(self) -> AsyncSession:
-        return self.scoped_session_factory()
+    def _return_permit(self):
+        if self._holds_permit:
+            self._holds_permit = False
+            self._permits.release()
 
+    async def connection(self, *args, **kw):
+        await self._take_permit()
+        return await super().connection(*args, **kw)
 
-async def get_warehouse_engine(db_string: str) -> any:
-    if db_string not in warehouse_cache:
-        warehouse_engine = create_async_engine(
-            db_string,
-            future=True,
-            echo=True,
-        )
-        warehouse_cache[db_string] = warehouse_engine
-    return warehouse_cache[db_string]
+    async def execute(self, *args, **kw):
+        await self._take_permit()
+        return await super().execute(*args, **kw)
+
+    async def scalar(self, *args, **kw):
+        await self._take_permit()
+        return await super().scalar(*args, **kw)
+
+    async def stream(self, *args, **kw):
+        await self._take_permit()
+        return await super().stream(*args, **kw)
+
+    async def close(self):
+        try:
+            await super().close()
+        finally:
+            self._return_permit()
+
+    async def invalidate(self):
+        try:
+            await super().invalidate()
+        finally:
+            self._return_permit()
+
+
+class EngineRegistry:
+    """
+    One warehouse engine and its session factory per tenant database, created once under a lock and leased
+    by the requests using them.
+
+    Connections, not engines, are what is bounded: every session of a registry engine holds one of the
+    worker's max_connections permits while it can have a connection checked out, and waits up to wait_timeout
+    seconds for one. A tenant never waits for an engine. Beyond max_engines, the least recently used idle
+    engines are disposed to make room, which bounds the connections idle pools keep open; engines nobody
+    leases are disposed after idle_timeout seconds. Pools are torn down outside the lock.
+    """
+
+    def __init__(self, max_engines: int, idle_timeout: float,
+                 create: Callable[[str], AsyncEngine] = create_warehouse_engine,
+                 max_connections: int = global_settings.warehouse_max_connections,
+                 wait_timeout: float | None = None):
+        self.max_engines = max(max_engines, 1)
+        self.idle_timeout = idle_timeout
+        self.create = create
+        self.connections = ConnectionPermits(max_connections, wait_timeout)
+        self._engines: OrderedDict[str, AsyncEngine] = OrderedDict()
+        self._session_factories: Dict[str, async_sessionmaker] = {}
+        self._leases: Dict[str, int] = {}
+        self._released_at: Dict[str, float] = {}
+        self._lock = Lock()
+        self.created = 0
+        self.disposed = 0
+
+    def _idle(self, db_string: str) -> bool:
+        return self._leases.get(db_string, 0) == 0
+
+    def _pop(self, db_string: str) -> AsyncEngine:
+        self._session_factories.pop(db_string, None)
+        self._leases.pop(db_string, None)
+        self._released_at.pop(db_string, None)
+        self.disposed += 1
+        return self._engines.pop(db_string)
+
+    def _evict(self, db_string: str) -> list[AsyncEngine]:
+        """Takes out the idle engines past idle_timeout, then the least recently used idle ones over max_engines."""
+        idle_before = time.monotonic() - self.idle_timeout
+        idle = [key for key in self._engines if key != db_string and self._idle(key)]
+        evicted = [key for key in idle if self._released_at.get(key, 0) <= idle_before]
+        # the registry is in least recently acquired order
+        over = len(self._engines) - len(evicted) + (db_string not in self._engines) - self.max_engines
+        evicted += [key for key in idle if key not in evicted][:max(over, 0)]
+        return [self._pop(key) for key in evicted]
+
+    async def acquire(self, db_string: str) -> async_sessionmaker:
+        """Leases the tenant's engine and returns its session factory."""
+        async with self._lock:
+            evicted = self._evict(db_string)
+            if db_string not in self._engines:
+                engine = self._engines[db_string] = self.create(db_string)
+                self._session_factories[db_string] = async_sessionmaker(
+                    engine,
+                    class_=WarehouseSession,
+                    permits=self.connections,
+                    autoflush=False,
+                    expire_on_commit=False,
+                )
+                self.created += 1
+            self._engines.move_to_end(db_string)
+            self._leases[db_string] = self._leases.get(db_string, 0) + 1
+            session_factory = self._session_factories[db_string]
+        try:
+            await _dispose_engines(evicted)
+        except BaseException:
+            await self.release(db_string)
+            raise
+        return session_factory
+
+    @asynccontextmanager
+    async def lease(self, db_string: str) -> AsyncIterator[async_sessionmaker]:
+        """Holds a lease of its own on the tenant's engine, e.g. for background work that outlives a request."""
+        session_factory = await self.acquire(db_string)
+        try:
+            yield session_factory
+        finally:
+            await self.release(db_string)
+
+    async def release(self, db_string: str):
+        async with self._lock:
+            if db_string in self._leases:
+                self._leases[db_string] -= 1
+                self._released_at[db_string] = time.monotonic()
+
+    async def close(self):
+        async with self._lock:
+            engines = [self._pop(db_string) for db_string in list(self._engines)]
+        await _dispose_engines(engines)
+
+    def stats(self) -> dict:
+        return {
+            'engines': len(self._engines),
+            'max_engines': self.max_engines,
+            'leased': sum(1 for key in self._engines if not self._idle(key)),
+            'created': self.created,
+            'disposed': self.disposed,
+            'connections': self.connections.in_use,
+            'max_connections': self.connections.limit,
+        }
+
+
+async def _dispose_engines(engines: Iterable[AsyncEngine]):
+    for engine in engines:
+        await engine.dispose()
+
+
+warehouse_engines = EngineRegistry(
+    global_settings.warehouse_max_connections
+    // (global_settings.warehouse_pool_size + global_settings.warehouse_max_overflow),
+    global_settings.warehouse_engine_idle_timeout,
+    max_connections=global_settings.warehouse_max_connections,
+    wait_timeout=global_settings.warehouse_connection_wait_timeout,
+)
+
+
+async def open_warehouse(tenant_db: str) -> DBManager:
+    db_string = global_settings.warehouse_url.unicode_string() + tenant_db
+    return DBManager(await warehouse_engines.acquire(db_string), engine_key=db_string)
+
+
+async def close_warehouse(db_manager: DBManager):
+    try:
+        if db_manager.snapshot_sessions:
+            # only pipelined batches open snapshot sessions
+            await _close_sessions(db_manager.snapshot_sessions.values())
+    finally:
+        if db_manager.engine_key is not None:
+            await warehouse_engines.release(db_manager.engine_key)
 
 
 # Updated Dependency
 async def get_warehouse(request: Request) -> DBManager:
-    db_string = global_settings.warehouse_url.unicode_string() + request.state.user['tenant_db']
-    warehouse_engine = await get_warehouse_engine(db_string)
-    async_session_factory = async_sessionmaker(
-        warehouse_engine,
-        autoflush=False,
-        expire_on_commit=False,
-    )
-    db_manager = DBManager(async_session_factory)
+    db_manager = await open_warehouse(request.state.user['tenant_db'])
     try:
         yield db_manager
     finally:
-        sessions = db_manager.scoped_session_factory.registry.registry.values()
-        await _close_sessions(sessions)
+        await close_warehouse(db_manager)
 
 
 ##############################################################################################################
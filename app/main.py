@@ -4,6 +4,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from app.utils.logging import AppLogger
 from app.api.health import router as health_router
 from app.redis import get_redis
+from app.database import warehouse_engines
 from app.services.auth import AuthBearer
 from app.api.functions import router as function_router
 
@@ -14,11 +15,14 @@ logger = AppLogger().get_logger()
 async def lifespan(app: FastAPI):
     # Load the redis connection
     app.state.redis = await get_redis()
+    app.state.cache_redis = await get_redis(decode_responses=False)
     try:
         yield
     finally:
         # close redis connection and release the resources
-        app.state.redis.close()
+        await app.state.redis.aclose()
+        await app.state.cache_redis.aclose()
+        await warehouse_engines.close()
 
 
 app = FastAPI(title="Stuff And Nonsense API", version="0.6", lifespan=lifespan)
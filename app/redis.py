@@ -3,9 +3,10 @@ import redis.asyncio as redis
 from app.config import settings as global_settings
 
 
-async def get_redis():
+async def get_redis(decode_responses: bool = True):
+    # the warehouse result cache stores compressed bytes, so it uses a client with decode_responses=False
     return await redis.from_url(
         global_settings.redis_url.unicode_string(),
         encoding="utf-8",
-        decode_responses=True,
+        decode_responses=decode_responses,
     )
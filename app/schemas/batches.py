@@ -1,10 +1,37 @@
-from pydantic import BaseModel
+from datetime import date
+from typing import Optional
+
+from pydantic import BaseModel, Field
 
 
 class BatchIn(BaseModel):
     platform: str
     request_batch: list[dict]
+    # run the batch on one connection per schema inside a single read-only snapshot
+    pipelined: bool = False
+    # answer with one NDJSON line per item, tagged with its batch index, as soon as it finishes
+    stream: bool = False
+    # time budget for the whole batch in seconds, defaults to settings.batch_timeout
+    timeout: Optional[float] = Field(default=None, gt=0)
 
 
 class BatchOut(BaseModel):
     response_batch: list[dict]
+
+
+class SyncIn(BaseModel):
+    # schema the sync (or reopen) signal is for; all of the tenant's schemas when omitted
+    schema_name: Optional[str] = None
+
+
+class ClosedThroughIn(BaseModel):
+    schema_name: str
+    # last day of the tenant's closed books; None falls back to the source system's lock date
+    closed_through: Optional[date] = None
+
+
+class WarmIn(BaseModel):
+    # schema to warm; all of the tenant's active schemas when omitted
+    schema_name: Optional[str] = None
+    # number of completed months, counting back from the current one, to precompute
+    months: Optional[int] = Field(default=None, ge=1, le=24)
@@ -0,0 +1,197 @@
+import dataclasses
+import inspect
+import json
+import types
+import typing
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
+
+from sqlalchemy import Select, Table, any_, bindparam, func, select
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from app.models.fivetranschema import FivetranSchema
+from app.models.warehouse import t_quickbooks__balance_sheet, t_sage_intacct__balance_sheet, \
+    t_xero__balance_sheet_report, \
+    t_sage_intacct__profit_and_loss, \
+    t_quickbooks__profit_and_loss, t_xero__profit_and_loss_report
+from app.services.type_converter import convert_to_column_type
+
+
+@dataclasses.dataclass(frozen=True)
+class ScalarTable:
+    """Where a scalar account function reads from: the table, its period column and the column it sums."""
+    table: Table
+    date_col: str
+    amount_col: str
+
+
+# (operation, source) -> table read by the scalar account functions that can be coalesced
+SCALAR_TABLES: dict[tuple[str, str], ScalarTable] = {
+    ('bs_acct', 'sage_intacct'): ScalarTable(t_sage_intacct__balance_sheet, 'period_date', 'amount'),
+    ('bs_acct', 'quickbooks'): ScalarTable(t_quickbooks__balance_sheet, 'calendar_date', 'amount'),
+    ('bs_acct', 'xero'): ScalarTable(t_xero__balance_sheet_report, 'date_month', 'net_amount'),
+    ('pl_acct', 'sage_intacct'): ScalarTable(t_sage_intacct__profit_and_loss, 'period_date', 'amount'),
+    ('pl_acct', 'quickbooks'): ScalarTable(t_quickbooks__profit_and_loss, 'calendar_date', 'amount'),
+    ('pl_acct', 'xero'): ScalarTable(t_xero__profit_and_loss_report, 'date_month', 'net_amount'),
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class GroupKey:
+    operation: str
+    schema_name: str
+    source: str
+    table_name: str
+    start_date: datetime
+    end_date: datetime
+    filter_col: str
+
+
+@dataclasses.dataclass
+class ScalarGroup:
+    """Scalar calls that differ only by filter value and can be answered by one GROUP BY query."""
+    key: GroupKey
+    spec: ScalarTable
+    # (batch index, converted filter value) for every call in the group
+    members: list[tuple[int, Any]] = dataclasses.field(default_factory=list)
+
+    @property
+    def operation(self) -> str:
+        return self.key.operation
+
+    @property
+    def filter_vals(self) -> list[Any]:
+        return list(dict.fromkeys(filter_val for _, filter_val in self.members))
+
+    def statement(self) -> Select:
+        tbl = self.spec.table
+        filter_column = tbl.c[self.key.filter_col]
+        filter_vals = bindparam('filter_vals', self.filter_vals, type_=ARRAY(filter_column.type))
+        return (
+            select(filter_column, func.sum(tbl.c[self.spec.amount_col]).label('total'))
+            .where(tbl.c[self.spec.date_col].between(self.key.start_date, self.key.end_date),
+                   filter_column == any_(filter_vals))
+            .group_by(filter_column)
+        )
+
+
+@dataclasses.dataclass
+class BatchPlan:
+    groups: list[ScalarGroup]
+    # batch indexes that run through their own handler method
+    singles: list[int]
+
+
+async def _group_member(query: dict, schemas: dict[str, FivetranSchema],
+                        period_to_date_range: Callable[..., Awaitable[tuple[datetime, datetime]]]
+                        ) -> tuple[GroupKey, ScalarTable, Any]:
+    """Resolves a bs_acct / pl_acct call to its group key, table spec and typed filter value."""
+    args = query['args']
+    schema = schemas[args['schema_name']]
+    spec = SCALAR_TABLES[(query['operation'], schema.source)]
+    if query['operation'] == 'bs_acct':
+        start_date, _ = await period_to_date_range(args['month'], 'MTD')
+        end_date = start_date
+    else:
+        start_date, end_date = await period_to_date_range(args['entry_date'], args['period'])
+    filter_col = args['filter_col'].lower().split(' ', 1)[0]
+    filter_val = convert_to_column_type(spec.table, filter_col, args['filter_val'])
+    key = GroupKey(query['operation'], args['schema_name'], schema.source, spec.table.name,
+                   start_date, end_date, filter_col)
+    return key, spec, filter_val
+
+
+async def plan_batch(query_batch: list[dict], schemas: dict[str, FivetranSchema],
+                     period_to_date_range: Callable[..., Awaitable[tuple[datetime, datetime]]]) -> BatchPlan:
+    """
+    Splits a request batch into coalesced scalar groups and items that run on their own.
+
+    bs_acct and pl_acct calls against the same schema, table, period range and filter column are grouped,
+    so the handler can answer all of them with a single
+    ``SELECT filter_col, sum(amount) ... WHERE filter_col = ANY(:filter_vals) GROUP BY filter_col``.
+    Calls that cannot be resolved (unknown schema, bad filter column or value) are left as singles,
+    so they fail through their own handler method exactly as before.
+    """
+    groups: dict[GroupKey, ScalarGroup] = {}
+    singles = []
+    for index, query in enumerate(query_batch):
+        if query.get('operation') not in ('bs_acct', 'pl_acct'):
+            singles.append(index)
+            continue
+        try:
+            key, spec, filter_val = await _group_member(query, schemas, period_to_date_range)
+        except (KeyError, ValueError, TypeError, ArithmeticError):
+            singles.append(index)
+            continue
+        groups.setdefault(key, ScalarGroup(key, spec)).members.append((index, filter_val))
+
+    # a group of one gains nothing over the handler method
+    coalesced = []
+    for group in groups.values():
+        if len(group.members) > 1:
+            coalesced.append(group)
+        else:
+            singles.extend(index for index, _ in group.members)
+    return BatchPlan(groups=coalesced, singles=sorted(singles))
+
+
+def _normalize_arg(value: Any, annotation: Any) -> Any:
+    """Coerces an Excel-supplied argument to its annotated type, so "1", 1 and True compare equal for a bool."""
+    if typing.get_origin(annotation) in (typing.Union, types.UnionType):
+        candidates = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+        annotation = candidates[0] if len(candidates) == 1 else Any
+    if value is None:
+        return None
+    if annotation is bool:
+        if isinstance(value, str):
+            return value.strip().lower() in ('true', '1', 'yes')
+        return bool(value)
+    if annotation in (int, float, str):
+        try:
+            return annotation(value)
+        except (TypeError, ValueError):
+            return value
+    return value
+
+
+def normalize_call(method: Optional[Callable], args: dict) -> Optional[dict]:
+    """Binds args to the handler method and coerces them to its annotations; None if they do not bind."""
+    if method is None:
+        return None
+    try:
+        signature = inspect.signature(method)
+        hints = typing.get_type_hints(method)
+        bound = signature.bind(**args)
+    except (TypeError, ValueError, NameError):
+        return None
+    bound.apply_defaults()
+    return {name: _normalize_arg(value, hints.get(name, Any)) for name, value in bound.arguments.items()}
+
+
+def dedupe_batch(query_batch: list[dict], handler: Any) -> tuple[list[dict], list[list[int]]]:
+    """
+    Collapses identical (operation, args) calls in a batch.
+
+    Returns the unique calls, with their args normalized against the handler method signature, and for
+    each unique call the batch indexes it answers. Calls whose args do not bind are kept as they are,
+    one per index, so they fail on their own.
+    """
+    unique_batch: list[dict] = []
+    fan_out: list[list[int]] = []
+    seen: dict[str, int] = {}
+    for index, query in enumerate(query_batch):
+        operation = query.get('operation')
+        args = normalize_call(getattr(handler, operation, None) if isinstance(operation, str) else None,
+                              query.get('args') or {})
+        if args is None:
+            unique_batch.append(query)
+            fan_out.append([index])
+            continue
+        key = json.dumps([operation, args], sort_keys=True, default=repr)
+        if key in seen:
+            fan_out[seen[key]].append(index)
+            continue
+        seen[key] = len(unique_batch)
+        unique_batch.append({'operation': operation, 'args': args})
+        fan_out.append([index])
+    return unique_batch, fan_out
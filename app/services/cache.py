@@ -0,0 +1,164 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+
+from app.config import settings as global_settings
+from app.services.cache_codec import decode_value, encode_value
+
+
+class LocalCache:
+    """
+    Bounded in-process cache for warehouse results: size-limited by bytes, TTL-aware, least recently used
+    entries are evicted first. Values are text or encoded frames; text is counted by its UTF-8 size.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # key -> (value, expiry, size in bytes)
+        self._entries: OrderedDict[str, tuple[Union[str, bytes], float, int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Union[str, bytes, None]:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key: str, value: Union[str, bytes], ttl: float) -> None:
+        if key in self._entries:
+            self._drop(key)
+        size = len(value) if isinstance(value, bytes) else len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, time.monotonic() + ttl, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self.size}
+
+
+local_cache = LocalCache(global_settings.local_cache_bytes)
+redis_stats = {'hits': 0, 'stale': 0, 'misses': 0}
+
+
+def fresh_key(key: str) -> str:
+    """Marker that lives for a value's soft TTL; once it is gone the value is stale but still served."""
+    return f"{key}:fresh"
+
+
+class TieredCache:
+    """
+    The worker's LocalCache in front of Redis; reads fall through tier by tier, writes go to both.
+    Redis holds values in the cache_codec format, so the client must use decode_responses=False.
+
+    One instance serves one request batch. Redis reads and writes issued by the batch's items in the
+    same event loop turn are coalesced into one pipelined round trip: a single MGET for all pending
+    keys and their freshness markers, followed by a SET ... EX per pending write and marker.
+    The local tier only ever holds fresh values.
+    """
+
+    def __init__(self, redis, local: LocalCache = local_cache):
+        self.redis = redis
+        self.local = local
+        self._reads: dict[str, list[asyncio.Future]] = {}
+        self._writes: dict[str, tuple[Union[str, bytes], int, int]] = {}
+        self._write_waiters: list[asyncio.Future] = []
+        self._flush: Optional[asyncio.Task] = None
+        self.round_trips = 0
+
+    def _schedule_flush(self) -> None:
+        # the flush task first runs on the next loop turn, after every item that is ready has queued its keys
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._run_flush())
+
+    async def _run_flush(self) -> None:
+        self._flush = None
+        reads, self._reads = self._reads, {}
+        writes, self._writes = self._writes, {}
+        write_waiters, self._write_waiters = self._write_waiters, []
+        try:
+            replies = await self._send(list(reads), writes)
+        except Exception as e:
+            for future in [*(f for futures in reads.values() for f in futures), *write_waiters]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        if reads:
+            self._resolve_reads(reads, replies[0])
+        for future in write_waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def _send(self, keys: list[str], writes: dict[str, tuple[Union[str, bytes], int, int]]) -> list:
+        """One pipelined round trip: an MGET of keys and their freshness markers, then every pending write."""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if keys:
+                pipe.mget(keys + [fresh_key(key) for key in keys])
+            for key, (value, ex, soft_ex) in writes.items():
+                pipe.set(key, encode_value(value), ex=ex)
+                pipe.set(fresh_key(key), b'1', ex=soft_ex)
+            replies = await pipe.execute()
+        self.round_trips += 1
+        return replies
+
+    def _resolve_reads(self, reads: dict[str, list[asyncio.Future]], values: list) -> None:
+        keys = list(reads)
+        markers = values[len(keys):]
+        for key, value, marker in zip(keys, map(decode_value, values[:len(keys)]), markers, strict=True):
+            fresh = marker is not None
+            if value and fresh:
+                redis_stats['hits'] += 1
+                # the remaining Redis TTL is unknown here, so keep the local copy briefly
+                self.local.set(key, value, global_settings.local_cache_ttl)
+            elif value:
+                redis_stats['stale'] += 1
+            else:
+                redis_stats['misses'] += 1
+            for future in reads[key]:
+                if not future.done():
+                    future.set_result((value, fresh))
+
+    async def get_entry(self, key: str) -> tuple[Union[str, bytes, None], bool]:
+        """Returns (value, fresh); a stale value is past its soft TTL but still within its hard one."""
+        value = self.local.get(key)
+        if value is not None:
+            return value, True
+        future = asyncio.get_running_loop().create_future()
+        self._reads.setdefault(key, []).append(future)
+        self._schedule_flush()
+        return await future
+
+    async def get(self, key: str) -> Union[str, bytes, None]:
+        value, _ = await self.get_entry(key)
+        return value
+
+    async def set(self, key: str, value: Union[str, bytes], ex: int, soft_ex: Optional[int] = None) -> None:
+        """Stores value for ex seconds; after soft_ex seconds (default ex) reads see it as stale."""
+        soft_ex = min(soft_ex or ex, ex)
+        self.local.set(key, value, soft_ex)
+        future = asyncio.get_running_loop().create_future()
+        self._writes[key] = (value, ex, soft_ex)
+        self._write_waiters.append(future)
+        self._schedule_flush()
+        await future
+
+
+def cache_stats() -> dict:
+    return {'local': local_cache.stats(), 'redis': dict(redis_stats)}
@@ -0,0 +1,50 @@
+import zlib
+from typing import Union
+
+from app.config import settings as global_settings
+
+# every cached value starts with MAGIC, the format version and the codec used for the payload;
+# from version 2 on a content byte follows, telling text apart from frame_codec frames
+MAGIC = b'XQ'
+FORMAT_VERSION = 2
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CONTENT_TEXT = 0
+CONTENT_FRAME = 1
+COMPRESS_LEVEL = 3
+
+
+def encode_value(value: Union[str, bytes]) -> bytes:
+    """
+    Serialises a cached result, text or an encoded frame, compressing it when it is at least
+    cache_compress_min_bytes long.
+    """
+    content = CONTENT_FRAME if isinstance(value, bytes) else CONTENT_TEXT
+    payload = value if isinstance(value, bytes) else value.encode('utf-8')
+    codec = CODEC_RAW
+    if len(payload) >= global_settings.cache_compress_min_bytes:
+        codec, payload = CODEC_ZLIB, zlib.compress(payload, COMPRESS_LEVEL)
+    return MAGIC + bytes((FORMAT_VERSION, codec, content)) + payload
+
+
+def decode_value(data: Union[bytes, str, None]) -> Union[str, bytes, None]:
+    """
+    Reverses encode_value: text comes back as str, frames as bytes. Values written before the header
+    existed are returned as plain text.
+    """
+    if data is None or isinstance(data, str):
+        return data
+    if not data.startswith(MAGIC) or len(data) < len(MAGIC) + 2:
+        return data.decode('utf-8')
+    version, codec = data[len(MAGIC)], data[len(MAGIC) + 1]
+    if version == 1:
+        content, payload = CONTENT_TEXT, data[len(MAGIC) + 2:]
+    elif version == FORMAT_VERSION:
+        content, payload = data[len(MAGIC) + 2], data[len(MAGIC) + 3:]
+    else:
+        raise ValueError(f'unsupported cache format version {version}')
+    if codec == CODEC_ZLIB:
+        payload = zlib.decompress(payload)
+    elif codec != CODEC_RAW:
+        raise ValueError(f'unsupported cache codec {codec}')
+    return payload if content == CONTENT_FRAME else payload.decode('utf-8')
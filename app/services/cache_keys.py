@@ -0,0 +1,49 @@
+import hashlib
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from typing import Any
+
+from sqlalchemy import Executable
+from sqlalchemy.dialects import postgresql
+
+CACHE_KEY_PREFIX = 'xqf'
+
+_dialect = postgresql.dialect()
+
+
+def _canonical_value(value: Any) -> Any:
+    """json.dumps fallback that renders bound values the same way regardless of their python type."""
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value.normalize())
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    return repr(value)
+
+
+def canonical_statement(stmt: Executable) -> str:
+    """
+    Renders a statement and its bound parameters into a stable string.
+
+    str(stmt) only shows the placeholders, so two calls for different periods or accounts would
+    render identically. Compiling against the postgres dialect gives the SQL plus the actual values,
+    which are serialised with sorted keys so the same query always produces the same text.
+    """
+    compiled = stmt.compile(dialect=_dialect)
+    return json.dumps({'sql': str(compiled), 'params': compiled.params},
+                      sort_keys=True, default=_canonical_value, separators=(',', ':'))
+
+
+def build_cache_key(tenant_db: str, schema_ref: str, operation: str, stmt: Executable, version: str = '0') -> str:
+    """
+    Returns a short, fixed-length Redis key for a warehouse query.
+
+    The key is namespaced by tenant, schema, handler operation and schema data version, followed by a
+    blake2b digest of the canonical statement, e.g. ``xqf:tenant_db:dbt_acme_sage_intacct:bs_acct:v3:9f86d0...``.
+    """
+    digest = hashlib.blake2b(canonical_statement(stmt).encode('utf-8'), digest_size=16).hexdigest()
+    return f"{CACHE_KEY_PREFIX}:{tenant_db}:{schema_ref}:{operation}:v{version}:{digest}"
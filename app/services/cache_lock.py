@@ -0,0 +1,49 @@
+import asyncio
+import uuid
+from typing import Awaitable, Callable, Union
+
+from app.config import settings as global_settings
+
+# delete the lease only if we still hold it, so a slow holder never frees somebody else's lease
+RELEASE_LEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+lock_stats = {'acquired': 0, 'waited': 0, 'fallback': 0}
+
+
+async def get_or_compute(redis, cache, cache_key: str,
+                         compute: Callable[[], Awaitable[Union[str, bytes, None]]]) -> Union[str, bytes, None]:
+    """
+    Computes a cache miss in at most one worker at a time.
+
+    The worker that wins ``SET <key>:lease NX PX`` runs compute(), which is expected to fill cache_key.
+    Everyone else polls cache_key through cache (a TieredCache) until the value lands, the lease disappears (the holder finished
+    without caching, or died) or cache_lock_wait runs out, and then computes it themselves.
+    """
+    lease_key = f"{cache_key}:lease"
+    token = uuid.uuid4().hex
+    if await redis.set(lease_key, token, nx=True, px=int(global_settings.cache_lock_lease * 1000)):
+        lock_stats['acquired'] += 1
+        try:
+            return await compute()
+        finally:
+            await redis.eval(RELEASE_LEASE, 1, lease_key, token)
+
+    loop = asyncio.get_running_loop()
+    give_up_at = loop.time() + global_settings.cache_lock_wait
+    delay = 0.02
+    while loop.time() < give_up_at:
+        await asyncio.sleep(delay)
+        cached_data = await cache.get(cache_key)
+        if cached_data:
+            lock_stats['waited'] += 1
+            return cached_data
+        if not await redis.exists(lease_key):
+            break
+        delay = min(delay * 2, 0.5)
+    lock_stats['fallback'] += 1
+    return await compute()
@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+from datetime import date, timedelta
+from typing import Optional
+
+from sqlalchemy import select
+
+from app.config import settings as global_settings
+from app.database import AsyncSessionFactory, DBManager, close_warehouse, open_warehouse
+from app.models.fivetranschema import FivetranSchema
+from app.models.tenant import Tenant
+from app.redis import get_redis
+from app.services.custom_function_handler import CustomFunctionHandler, build_schemas
+from app.utils.logging import AppLogger
+
+logger = AppLogger().get_logger()
+
+# sources whose dbt models support a trial balance
+TRIAL_BALANCE_SOURCES = ('sage_intacct', 'quickbooks')
+
+
+def excel_serial(day: date) -> int:
+    """The PC Excel date number of a day, the inverse of CustomFunctionHandler.excel_date_to_datetime."""
+    return day.toordinal() - date(1900, 1, 1).toordinal() + 2
+
+
+def recent_month_ends(months: int, today: Optional[date] = None) -> list[date]:
+    """Last day of each of the `months` completed months before today, most recent first."""
+    month_end = (today or date.today()).replace(day=1) - timedelta(days=1)
+    month_ends = []
+    for _ in range(months):
+        month_ends.append(month_end)
+        month_end = month_end.replace(day=1) - timedelta(days=1)
+    return month_ends
+
+
+def warm_batch(schemas: dict[str, FivetranSchema], months: int, today: Optional[date] = None) -> list[dict]:
+    """
+    The standard month-end statements of every active schema for the last `months` months: balance sheet,
+    MTD P&L (which YTD and QTD are composed from) and, where the source has one, MTD trial balance.
+    """
+    batch = []
+    for schema_name, schema in schemas.items():
+        if not schema.is_active:
+            continue
+        for month_end in recent_month_ends(months, today):
+            month = excel_serial(month_end)
+            batch.append({'operation': 'balance_sheet', 'args': {'schema_name': schema_name, 'month': month}})
+            batch.append({'operation': 'profit_and_loss',
+                          'args': {'schema_name': schema_name, 'month': month, 'period': 'MTD'}})
+            if schema.source in TRIAL_BALANCE_SOURCES:
+                batch.append({'operation': 'trial_balance',
+                              'args': {'schema_name': schema_name, 'period_last_day': month, 'period': 'MTD'}})
+    return batch
+
+
+async def warm_tenant(wh_session: DBManager, schemas: dict[str, FivetranSchema], tenant_db: str, redis,
+                      cache_redis, months: int = global_settings.warm_months) -> dict:
+    """
+    Precomputes a tenant's standard statements into the cache, e.g. right after a sync has landed.
+    Every warm item is a bulk function, so the batch runs in the tenant's bulk lane, with warm_concurrency
+    warehouse calls at most and each holding a connection only for its slot.
+    """
+    batch = warm_batch(schemas, months)
+    handler = CustomFunctionHandler(wh_session, 'PC', batch, schemas, tenant_db, redis,
+                                    timeout=global_settings.warm_timeout, cache_redis=cache_redis,
+                                    concurrency=global_settings.warm_concurrency)
+    results = await handler.execute()
+    failed = [{**query, 'error': result.value} for query, result in zip(batch, results, strict=True)
+              if result.status == 'error']
+    return {'warmed': len(batch) - len(failed), 'failed': failed}
+
+
+async def warm_tenant_db(tenant_db: str, schemas: dict[str, FivetranSchema], redis, cache_redis,
+                         months: int = global_settings.warm_months) -> dict:
+    """warm_tenant on a warehouse lease of its own, for warm jobs that outlive the request queuing them."""
+    wh_session = await open_warehouse(tenant_db)
+    try:
+        return await warm_tenant(wh_session, schemas, tenant_db, redis, cache_redis, months)
+    finally:
+        await close_warehouse(wh_session)
+
+
+async def main(tenant_id: int, months: int, schema_name: Optional[str] = None) -> dict:
+    async with AsyncSessionFactory() as db_session:
+        async with db_session.begin():
+            tenant_db = await db_session.scalar(select(Tenant.db_name).where(Tenant.id == tenant_id))
+            schemas = await build_schemas(db_session, tenant_id)
+    if tenant_db is None:
+        raise SystemExit(f'tenant {tenant_id} not found')
+    if schema_name is not None:
+        schemas = {schema_name: schemas[schema_name]}
+    redis = await get_redis()
+    cache_redis = await get_redis(decode_responses=False)
+    try:
+        return await warm_tenant_db(tenant_db, schemas, redis, cache_redis, months)
+    finally:
+        await redis.aclose()
+        await cache_redis.aclose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute a tenant\'s month-end statements into the cache.')
+    parser.add_argument('tenant_id', type=int)
+    parser.add_argument('--months', type=int, default=global_settings.warm_months)
+    parser.add_argument('--schema', dest='schema_name')
+    args = parser.parse_args()
+    result = asyncio.run(main(args.tenant_id, args.months, args.schema_name))
+    logger.info('warmed %d statements of tenant %d', result['warmed'], args.tenant_id)
+    for failure in result['failed']:
+        logger.warning('warming %s %s failed: %s', failure['operation'], failure['args'], failure['error'])
@@ -0,0 +1,103 @@
+import time
+from datetime import date
+from typing import Awaitable, Callable, Optional
+
+import pandas as pd
+from sqlalchemy import Select, func, select
+from sqlalchemy.exc import ProgrammingError
+
+from app.config import settings as global_settings
+from app.models.warehouse import t_company_pref, t_organization
+from app.utils.logging import AppLogger
+
+logger = AppLogger().get_logger()
+
+# SQLSTATEs of a connector schema that lacks the lock date: no such schema, table or column
+_MISSING_LOCK_TABLE = frozenset({'3F000', '42P01', '42703'})
+
+# closed-period policy as last resolved by this worker: (tenant_db, schema_ref) -> (closed through, generation, expiry)
+_probes: dict[tuple[str, str], tuple[Optional[date], str, float]] = {}
+
+
+def _key(tenant_db: str, schema_ref: str, field: str) -> str:
+    return f"xqf:closed:{tenant_db}:{schema_ref}:{field}"
+
+
+def lock_date_statement(source: str) -> Optional[Select]:
+    """Reads the books-closed date a source system keeps in its connector schema, if it keeps one."""
+    if source == 'xero':
+        return select(func.max(func.greatest(t_organization.c.period_lock_date,
+                                             t_organization.c.end_of_year_lock_date)))
+    if source == 'sage_intacct' and global_settings.sage_lock_date_property:
+        return (select(t_company_pref.c.value)
+                .where(t_company_pref.c.property == global_settings.sage_lock_date_property,
+                       t_company_pref.c._fivetran_deleted.isnot(True))
+                .limit(1))
+    # the QuickBooks connector tables carry no closing date; those tenants set it through set_closed_through
+    return None
+
+
+def missing_lock_table(error: Exception) -> bool:
+    """Whether a lock date query failed because the connector schema does not have the table it reads."""
+    return isinstance(error, ProgrammingError) and getattr(error.orig, 'sqlstate', None) in _MISSING_LOCK_TABLE
+
+
+def parse_lock_date(value: Optional[str]) -> Optional[date]:
+    if not value:
+        return None
+    try:
+        return pd.Timestamp(value).date()
+    except (ValueError, TypeError):
+        return None
+
+
+async def get_closed_period(redis, tenant_db: str, schema_ref: str,
+                            source_lock_date: Callable[[], Awaitable[Optional[date]]]) -> tuple[Optional[date], str]:
+    """
+    Returns (closed through, closed generation) for a schema.
+
+    Results that only cover periods ending on or before the closed-through date are keyed by the generation
+    instead of the data version, so syncs leave them alone. The tenant's configured date wins over the source
+    system's lock date. If the effective date moves back, the generation is bumped exactly like an explicit
+    reopen, so results cached while a period was closed are not served again after it was reopened.
+    When the source lock date cannot be read, the last date seen is kept, so a failed probe never counts as a reopen.
+    The policy is kept in-process for data_version_ttl seconds.
+    """
+    probe = _probes.get((tenant_db, schema_ref))
+    if probe is not None and probe[2] > time.monotonic():
+        return probe[0], probe[1]
+    configured = await redis.get(_key(tenant_db, schema_ref, 'through'))
+    seen = await redis.get(_key(tenant_db, schema_ref, 'seen'))
+    if configured:
+        closed_through = date.fromisoformat(configured)
+    else:
+        try:
+            closed_through = await source_lock_date()
+        except Exception as e:
+            logger.warning('reading the lock date of %s failed, keeping %s: %s', schema_ref, seen, e)
+            closed_through = date.fromisoformat(seen) if seen else None
+    if seen and (closed_through is None or closed_through < date.fromisoformat(seen)):
+        await redis.incr(_key(tenant_db, schema_ref, 'generation'))
+    if closed_through is None:
+        await redis.delete(_key(tenant_db, schema_ref, 'seen'))
+    elif closed_through.isoformat() != seen:
+        await redis.set(_key(tenant_db, schema_ref, 'seen'), closed_through.isoformat())
+    generation = await redis.get(_key(tenant_db, schema_ref, 'generation')) or '0'
+    _probes[(tenant_db, schema_ref)] = (closed_through, generation, time.monotonic() + global_settings.data_version_ttl)
+    return closed_through, generation
+
+
+async def set_closed_through(redis, tenant_db: str, schema_ref: str, closed_through: Optional[date]) -> None:
+    """Stores the tenant's books-closed date for a schema; None falls back to the source system's lock date."""
+    if closed_through is None:
+        await redis.delete(_key(tenant_db, schema_ref, 'through'))
+    else:
+        await redis.set(_key(tenant_db, schema_ref, 'through'), closed_through.isoformat())
+    _probes.pop((tenant_db, schema_ref), None)
+
+
+async def reopen_periods(redis, tenant_db: str, schema_ref: str) -> int:
+    """Drops every closed-period result of a schema by starting a new closed generation."""
+    generation = await redis.incr(_key(tenant_db, schema_ref, 'generation'))
+    _probes.pop((tenant_db, schema_ref), None)
+    return generation
@@ -1,21 +1,39 @@
 import asyncio
+import contextlib
+import contextvars
 import dataclasses
-from datetime import datetime, date
-from typing import Any, Literal, Optional
-from type_converter import convert_to_column_type
+import io
+import json
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from typing import Any, AsyncIterator, Awaitable, Callable, Literal, Optional, Union
+from app.services.type_converter import convert_to_column_type
+from app.services.batch_planner import SCALAR_TABLES, ScalarGroup, dedupe_batch, plan_batch
+from app.services.cache import TieredCache
+from app.services.cache_keys import build_cache_key
+from app.services.cache_lock import get_or_compute
+from app.services.closed_periods import get_closed_period, lock_date_statement, missing_lock_table, parse_lock_date
+from app.services.data_version import get_data_version
+from app.services.frame_codec import decode_frame, encode_frame, frame_to_json
+from app.services.scheduler import BatchScheduler, operation_lane
+from app.services.schema_sql import qualified_text
+from app.services.sql_catalog import catalog_sql, catalog_statement
+from app.services.singleflight import SingleFlight, warehouse_flights
+from app.config import settings as global_settings
 from app.models.warehouse.dbt_quickbooks import t_quickbooks__ap_ar_enhanced
 
-from app.database import DBManager
+from app.database import DBManager, apply_statement_timeout, schema_options, warehouse_engines
 from app.models.fivetranschema import FivetranSchema
+from app.utils.logging import AppLogger
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, text, Executable, table, column, ColumnElement, func, inspect, bindparam, Table
+from sqlalchemy import select, text, Executable, Result, table, column, ColumnElement, func, inspect, bindparam, Table
 import pandas as pd
 import numpy as np
-from app.models.warehouse import t_quickbooks__balance_sheet, t_sage_intacct__balance_sheet, \
-    t_xero__balance_sheet_report, \
-    t_sage_intacct__ap_ar_enhanced, t_xero__invoice_line_items, t_quickbooks__ap_ar_enhanced, \
-    t_sage_intacct__profit_and_loss, \
-    t_quickbooks__profit_and_loss, t_xero__profit_and_loss_report
+from app.models.warehouse import t_sage_intacct__ap_ar_enhanced, t_xero__invoice_line_items, \
+    t_quickbooks__ap_ar_enhanced
+
+
+logger = AppLogger().get_logger()
 
 
 async def build_schemas(db_session: AsyncSession, tenant_id) -> dict[str, FivetranSchema]:
@@ -90,6 +108,72 @@ def convert_dates_to_excel_int(df, system):
         return df
 
 
+def _serialize_scalar(result: Result) -> Optional[str]:
+    data = result.scalar()
+    return None if data is None else str(data)
+
+
+def _serialize_nullable_scalar(result: Result) -> str:
+    """Like _serialize_scalar, but as JSON, so a NULL is cached as well."""
+    data = result.scalar()
+    return json.dumps(None if data is None else str(data))
+
+
+def _serialize_tabular(result: Result) -> bytes:
+    return encode_frame(pd.DataFrame(result.fetchall()))
+
+
+def _serialize_grouped(result: Result) -> str:
+    return json.dumps({str(filter_val): total for filter_val, total in result.all()}, default=str)
+
+
+def _sum_matching(df: pd.DataFrame, filter_col: str, filter_val: Any, amount_col: str) -> Optional[str]:
+    """sum(amount_col) WHERE filter_col = filter_val over a decoded statement, rendered like _serialize_scalar."""
+    column = df[filter_col]
+    if filter_val is None:
+        return None
+    if pd.api.types.is_datetime64_any_dtype(column):
+        filter_val = pd.Timestamp(filter_val)
+    elif pd.api.types.is_numeric_dtype(column) and not pd.api.types.is_bool_dtype(column):
+        filter_val = float(filter_val)
+    amounts = df.loc[column == filter_val, amount_col].dropna()
+    if amounts.empty:
+        return None
+    # frames keep numeric amounts as Decimal, so the sum has the scale Postgres gives sum(numeric)
+    return str(sum((amount if isinstance(amount, Decimal) else Decimal(str(amount)) for amount in amounts),
+                   Decimal(0)))
+
+
+def _month_end(day: datetime) -> datetime:
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+def _month_slices(start_date: datetime, end_date: datetime) -> list[tuple[datetime, datetime]]:
+    """Splits a period range into calendar months; the last month ends at end_date."""
+    slices = []
+    month_start = start_date
+    while month_start <= end_date:
+        slices.append((month_start, min(_month_end(month_start), end_date)))
+        month_start = _month_end(month_start) + timedelta(days=1)
+    return slices
+
+
+# background refreshes of stale cache entries in this worker, by cache key
+revalidations: dict[str, asyncio.Task] = {}
+
+
+def _revalidated(cache_key: str, task: asyncio.Task) -> None:
+    revalidations.pop(cache_key, None)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning('refreshing %s failed: %s', cache_key, task.exception())
+
+
+# loop time by which the warehouse work of the current batch item has to finish
+item_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('item_deadline', default=None)
+# scheduler lane the current batch item's warehouse work runs in
+item_lane: contextvars.ContextVar[str] = contextvars.ContextVar('item_lane', default='bulk')
+
+
 @dataclasses.dataclass
 class Response:
     status: Literal['success', 'error']
@@ -99,46 +183,313 @@ class Response:
 
 class CustomFunctionHandler:
     def __init__(self, wh_session: DBManager, platform: str, query_batch: list[dict],
-                 schemas: dict[str, FivetranSchema], tenant_db: str, redis):
+                 schemas: dict[str, FivetranSchema], tenant_db: str, redis, pipelined: bool = False,
+                 timeout: Optional[float] = None, cache_redis=None, concurrency: Optional[int] = None):
         self.wh_session = wh_session
         self.platform = platform
         self.query_batch = query_batch
         self.schemas = schemas
         self.tenant_db = tenant_db
         self.redis = redis
-
-    async def scalar_query(self, stmt: Executable, schema_ref: str) -> any:
-        cache_key = f"{self.tenant_db}_{schema_ref}_{stmt}"
-        cached_data = await self.redis.get(cache_key)
-        if cached_data:
-            return cached_data
-        else:
-            db_session = self.wh_session.get_session()
-            await db_session.execute(text(f"SET search_path TO {schema_ref}"))
-            result = await db_session.execute(stmt)
-            data = await result.scalar()
-            await self.redis.set(cache_key, data, ex=300)
-            return data
-
-    async def tabular_query(self, stmt: Executable, schema_ref: str) -> str:
-        # check if sql query is in redis cache
-        cache_key = f"{self.tenant_db}_{schema_ref}_{stmt}"
-        cached_data = await self.redis.get(cache_key)
+        self.schemas_by_ref = {schema.build_dbt_schema(): schema for schema in schemas.values() if schema.schema_name}
+        self.cache = TieredCache(cache_redis)
+        self.pipelined = pipelined
+        # pipelined work runs on this request's snapshots, which close with the request,
+        # so it is only shared between the request's own items, never with other requests
+        self.flights = SingleFlight() if pipelined else warehouse_flights
+        self.timeout = timeout or global_settings.batch_timeout
+        self.deadline: Optional[float] = None
+        self.scheduler = BatchScheduler(tenant_db, concurrency or global_settings.batch_concurrency)
+
+    def _statement_timeout(self) -> Optional[int]:
+        """Milliseconds left before the current item's deadline, used as the server-side statement_timeout."""
+        deadline = item_deadline.get()
+        if deadline is None:
+            return None
+        return int((deadline - asyncio.get_running_loop().time()) * 1000)
+
+    async def _execute(self, stmt: Executable, schema_ref: str):
+        if self.pipelined:
+            return await self.wh_session.get_snapshot_session(schema_ref).execute(stmt, self._statement_timeout())
+        # only warehouse work takes a slot in the item's lane; cache hits never queue behind it.
+        # The session lives exactly as long as the slot, so a lane's limit bounds its pooled connections.
+        async with self.scheduler.slot(item_lane.get()):
+            async with self.wh_session.async_session_factory() as db_session:
+                await apply_statement_timeout(db_session, self._statement_timeout())
+                return await db_session.execute(stmt, execution_options=schema_options(schema_ref))
+
+    async def _fill(self, cache_key: str, ttl: int, soft_ttl: int, stmt: Executable, schema_ref: str,
+                    serialize: Callable[[Result], Union[str, bytes, None]]) -> Union[str, bytes, None]:
+        result = await self._execute(stmt, schema_ref)
+        data = serialize(result)
+        if data is not None:
+            await self.cache.set(cache_key, data, ex=ttl, soft_ex=soft_ttl)
+        return data
+
+    def _revalidate(self, cache_key: str, ttl: int, soft_ttl: int, stmt: Executable, schema_ref: str,
+                    serialize: Callable[[Result], Union[str, bytes, None]]) -> None:
+        """Starts a background refresh of a stale entry, unless this worker is already refreshing it."""
+        if cache_key in revalidations:
+            return
+        task = asyncio.ensure_future(self._refresh(cache_key, ttl, soft_ttl, stmt, schema_ref, serialize))
+        revalidations[cache_key] = task
+        task.add_done_callback(lambda done: _revalidated(cache_key, done))
+
+    async def _refresh(self, cache_key: str, ttl: int, soft_ttl: int, stmt: Executable, schema_ref: str,
+                       serialize: Callable[[Result], Union[str, bytes, None]]) -> None:
+        """
+        Re-runs a stale query and rewrites its entry. The refresh lease is left to expire rather than released,
+        so workers that read the stale value just before the rewrite do not refresh it again.
+        It outlives the request that noticed the stale value, so it holds an engine lease of its own and
+        runs in a bulk slot on a session scoped to that slot; it is cut off by the refresh lease rather
+        than by an item deadline, on the server as well.
+        """
+        lease = int(global_settings.cache_lock_lease * 1000)
+        if not await self.redis.set(f'{cache_key}:refresh', '1', nx=True, px=lease):
+            return
+        async with self._engine_lease() as session_factory:
+            async with self.scheduler.slot('bulk'):
+                async with session_factory() as db_session:
+                    await apply_statement_timeout(db_session, lease)
+                    data = serialize(await asyncio.wait_for(
+                        db_session.execute(stmt, execution_options=schema_options(schema_ref)), lease / 1000))
+        if data is not None:
+            await self.cache.set(cache_key, data, ex=ttl, soft_ex=soft_ttl)
+
+    @contextlib.asynccontextmanager
+    async def _engine_lease(self) -> AsyncIterator[Callable[[], AsyncSession]]:
+        """The warehouse session factory, leased from the engine registry when the engine is registry-managed."""
+        if self.wh_session.engine_key is None:
+            yield self.wh_session.async_session_factory
+            return
+        async with warehouse_engines.lease(self.wh_session.engine_key) as session_factory:
+            yield session_factory
+
+    async def _source_lock_date(self, schema: FivetranSchema) -> Optional[date]:
+        """
+        The lock date the source system keeps, None if it keeps none; a failed query raises. Most tenants have
+        no lock date, so its absence is cached like a date.
+        """
+        stmt = lock_date_statement(schema.source)
+        if stmt is None:
+            return None
+        try:
+            data = await self._cached_query(stmt, schema.build_schema(), 'source_lock_date', _serialize_nullable_scalar)
+            return parse_lock_date(json.loads(data))
+        except Exception as e:
+            if missing_lock_table(e):
+                # a connector schema without the settings table simply has no closed periods
+                return None
+            raise
+
+    async def _cache_key(self, stmt: Executable, schema_ref: str, operation: str,
+                         period_end: Optional[date] = None) -> tuple[str, int, int]:
+        """
+        Returns the cache key, hard TTL and soft TTL for a warehouse query. period_end is the last day the result
+        covers; results that end inside the schema's closed periods outlive syncs, never go stale and are only
+        dropped by a reopen.
+        """
+        schema = self.schemas_by_ref.get(schema_ref)
+        if period_end is not None and schema is not None:
+            closed_through, generation = await self.flights.do(
+                f'closed:{self.tenant_db}:{schema_ref}',
+                lambda: get_closed_period(self.redis, self.tenant_db, schema_ref,
+                                          lambda: self._source_lock_date(schema)))
+            if isinstance(period_end, datetime):
+                period_end = period_end.date()
+            if closed_through is not None and period_end <= closed_through:
+                return (build_cache_key(self.tenant_db, schema_ref, operation, stmt, f'c{generation}'),
+                        global_settings.closed_period_cache_ttl, global_settings.closed_period_cache_ttl)
+        version = await get_data_version(self.redis, self.tenant_db, schema_ref)
+        return (build_cache_key(self.tenant_db, schema_ref, operation, stmt, version),
+                global_settings.cache_ttl, global_settings.cache_soft_ttl)
+
+    async def _cached_query(self, stmt: Executable, schema_ref: str, operation: str,
+                            serialize: Callable[[Result], Union[str, bytes, None]],
+                            period_end: Optional[date] = None) -> Union[str, bytes, None]:
+        """
+        Returns the cached string for a warehouse query, or runs it and caches serialize(result).
+        Concurrent misses for the same key share a single warehouse query, within this process
+        through the singleflight and across workers through a Redis lease. A stale value is returned
+        as is while a background refresh replaces it.
+        """
+        cache_key, ttl, soft_ttl = await self._cache_key(stmt, schema_ref, operation, period_end)
+        cached_data, fresh = await self.cache.get_entry(cache_key)
         if cached_data:
+            if not fresh:
+                self._revalidate(cache_key, ttl, soft_ttl, stmt, schema_ref, serialize)
             return cached_data
+        return await self.flights.do(cache_key, lambda: get_or_compute(
+            self.redis, self.cache, cache_key,
+            lambda: self._fill(cache_key, ttl, soft_ttl, stmt, schema_ref, serialize)))
+
+    async def scalar_query(self, stmt: Executable, schema_ref: str, operation: str,
+                           period_end: Optional[date] = None) -> any:
+        return await self._cached_query(stmt, schema_ref, operation, _serialize_scalar, period_end)
+
+    async def tabular_frame(self, stmt: Executable, schema_ref: str, operation: str,
+                            period_end: Optional[date] = None) -> pd.DataFrame:
+        """Returns a tabular result as a DataFrame, decoded from the cached columnar frame."""
+        data = await self._cached_query(stmt, schema_ref, operation, _serialize_tabular, period_end)
+        if isinstance(data, str):
+            # JSON cached before tabular results were stored as frames
+            return pd.read_json(io.StringIO(data), orient='split')
+        return decode_frame(data)
+
+    async def tabular_query(self, stmt: Executable, schema_ref: str, operation: str,
+                            period_end: Optional[date] = None) -> str:
+        return frame_to_json(await self.tabular_frame(stmt, schema_ref, operation, period_end))
+
+    async def grouped_scalar_query(self, stmt: Executable, schema_ref: str, operation: str,
+                                   period_end: Optional[date] = None) -> dict[str, Any]:
+        """Runs a coalesced GROUP BY query and returns the totals keyed by the string form of the filter value."""
+        return json.loads(await self._cached_query(stmt, schema_ref, operation, _serialize_grouped, period_end))
+
+    async def _profit_and_loss_frame(self, schema_name: str, start_date: datetime, end_date: datetime,
+                                     fill: bool = True) -> Optional[pd.DataFrame]:
+        """
+        Returns the P&L for a range composed from per-month slices, each cached under its own month statement,
+        so a Dec YTD after a Nov YTD only has to query December. Missing months are fetched in one statement
+        and split back into slices. With fill=False nothing is queried and None means a month is not cached.
+        """
+        schema = self.schemas[schema_name]
+        schema_ref = schema.build_dbt_schema()
+        months = _month_slices(start_date, end_date)
+        stmts = [self._profit_and_loss_statement(schema.source, schema_ref, month_start, month_end)
+                 for month_start, month_end in months]
+        keyed = await asyncio.gather(*(self._cache_key(stmt, schema_ref, 'profit_and_loss', month_end)
+                                       for stmt, (_, month_end) in zip(stmts, months, strict=True)))
+        keys = [key for key, _, _ in keyed]
+        # the lookups for every month go out in the same MGET
+        entries = await asyncio.gather(*(self.cache.get_entry(key) for key in keys))
+        cached = [data for data, _ in entries]
+        missing = [i for i, data in enumerate(cached) if not isinstance(data, bytes)]
+        for stmt, (cache_key, ttl, soft_ttl), (data, fresh) in zip(stmts, keyed, entries, strict=True):
+            if isinstance(data, bytes) and not fresh:
+                self._revalidate(cache_key, ttl, soft_ttl, stmt, schema_ref, _serialize_tabular)
+        if missing and not fill:
+            return None
+        if len(missing) > 1:
+            first, last = missing[0], missing[-1]
+            await self.flights.do(f'{keys[first]}..{keys[last]}', lambda: get_or_compute(
+                self.redis, self.cache, keys[last],
+                lambda: self._fill_months(schema.source, schema_ref, months[first:last + 1], keyed[first:last + 1])))
+            cached = await asyncio.gather(*(self.cache.get(key) for key in keys))
+        frames = []
+        for stmt, (_, month_end), data in zip(stmts, months, cached, strict=True):
+            # a single missing month, or one that did not land in the cache, goes through the regular path
+            frame = decode_frame(data) if isinstance(data, bytes) else await self.tabular_frame(
+                stmt, schema_ref, 'profit_and_loss', month_end)
+            frames.append(frame)
+        populated = [frame for frame in frames if len(frame)]
+        if len(populated) == 1:
+            return populated[0]
+        return pd.concat(populated, ignore_index=True) if populated else frames[-1]
+
+    async def _fill_months(self, source: str, schema_ref: str, months: list[tuple[datetime, datetime]],
+                           keyed: list[tuple[str, int, int]]) -> bytes:
+        """Queries a run of P&L months in one statement and caches each month's rows as its own slice."""
+        result = await self._execute(self._profit_and_loss_statement(source, schema_ref, months[0][0],
+                                                                      months[-1][1]), schema_ref)
+        df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+        dates = pd.to_datetime(df[SCALAR_TABLES[('pl_acct', source)].date_col])
+        slices = [encode_frame(df[(dates >= month_start) & (dates <= month_end)].reset_index(drop=True))
+                  for month_start, month_end in months]
+        await asyncio.gather(*(self.cache.set(key, data, ex=ttl, soft_ex=soft_ttl)
+                               for (key, ttl, soft_ttl), data in zip(keyed, slices, strict=True)))
+        return slices[-1]
+
+    async def _totals_from_statement(self, operation: str, schema_name: str, start_date: datetime,
+                                     end_date: datetime, filter_col: str,
+                                     filter_vals: list[Any]) -> Optional[dict[str, Optional[str]]]:
+        """
+        Answers bs_acct / pl_acct calls in memory from the balance sheet or P&L slices for the same period,
+        keyed by the string form of the filter value. Returns None when the statement is not available;
+        a balance sheet or a single P&L month is only looked up, multi-month P&L ranges fill their missing months.
+        """
+        schema = self.schemas[schema_name]
+        if operation == 'bs_acct':
+            schema_ref = schema.build_dbt_schema()
+            stmt = self._balance_sheet_statement(schema.source, schema_ref, start_date)
+            cache_key, _, _ = await self._cache_key(stmt, schema_ref, 'balance_sheet', _month_end(start_date))
+            data = await self.cache.get(cache_key)
+            # nothing cached, or JSON cached before tabular results were stored as frames
+            df = decode_frame(data) if isinstance(data, bytes) else None
+            amount_col = SCALAR_TABLES[(operation, schema.source)].amount_col
         else:
-            db_session = self.wh_session.get_session()
-            await db_session.execute(text(f"SET search_path TO {schema_ref}"))
-            result = await db_session.execute(stmt)
-            result = result.fetchall()
-            df = pd.DataFrame(result)
-            data = df.to_json(orient='split', date_format='iso')
-            await self.redis.set(cache_key, data, ex=300)
-            return df.to_json(orient='split', date_format='iso')
-
-    async def execute(self) -> tuple[Any]:
-        coroutines = [getattr(self, query['operation'])(**query['args']) for query in self.query_batch]
-        return await asyncio.gather(*coroutines)
+            fill = len(_month_slices(start_date, end_date)) > 1
+            # filling months pulls whole statements, which belong in the bulk lane even for a scalar cell
+            lane = item_lane.set('bulk')
+            try:
+                df = await self._profit_and_loss_frame(schema_name, start_date, end_date, fill=fill)
+            finally:
+                item_lane.reset(lane)
+            amount_col = 'total'
+        if df is None or filter_col not in df.columns or amount_col not in df.columns:
+            return None
+        if pd.api.types.is_float_dtype(df[amount_col]):
+            # a frame cached before amounts were kept exact; its float sums would not match the SQL result
+            return None
+        return {str(filter_val): _sum_matching(df, filter_col, filter_val, amount_col) for filter_val in filter_vals}
+
+    async def _run_group(self, group: ScalarGroup) -> list[tuple[int, Response]]:
+        """Answers every call of a coalesced scalar group from one warehouse query."""
+        item_lane.set('scalar')
+        try:
+            key = group.key
+            totals = await self._totals_from_statement(group.operation, key.schema_name, key.start_date,
+                                                       key.end_date, key.filter_col, group.filter_vals)
+            if totals is None:
+                schema_ref = self.schemas[key.schema_name].build_dbt_schema()
+                # balance sheet groups are dated at the start of their month, so count the whole month
+                totals = await self.grouped_scalar_query(group.statement(), schema_ref, group.operation,
+                                                         _month_end(key.end_date))
+        except Exception as e:
+            return [(index, Response(status='error', type='scalar', value=str(e))) for index, _ in group.members]
+        return [(index, Response(status='success', type='tabular', value=totals.get(str(filter_val))))
+                for index, filter_val in group.members]
+
+    async def _run_item(self, index: int, query: dict) -> list[tuple[int, Response]]:
+        item_lane.set(operation_lane(query['operation']))
+        return [(index, await getattr(self, query['operation'])(**query['args']))]
+
+    async def _with_deadline(self, run: Awaitable[list[tuple[int, Response]]],
+                             indexes: list[int]) -> list[tuple[int, Response]]:
+        """Runs one unit of work against the batch deadline; on expiry its items come back as errors."""
+        item_deadline.set(self.deadline)
+        try:
+            return await asyncio.wait_for(run, timeout=self.deadline - asyncio.get_running_loop().time())
+        except asyncio.TimeoutError:
+            error = Response(status='error', type='scalar', value=f'timed out after {self.timeout:g}s')
+            return [(index, error) for index in indexes]
+
+    async def iter_results(self) -> AsyncIterator[tuple[int, Response]]:
+        """Yields (batch index, response) pairs in completion order, so callers can stream them."""
+        self.deadline = asyncio.get_running_loop().time() + self.timeout
+        # identical calls run once and fan out to every index that asked for them
+        unique_batch, fan_out = dedupe_batch(self.query_batch, self)
+        plan = await plan_batch(unique_batch, self.schemas, self.period_to_date_range)
+        tasks = [asyncio.ensure_future(self._with_deadline(self._run_group(group), [i for i, _ in group.members]))
+                 for group in plan.groups]
+        # scalar cells are started first so they are first in line for their lane
+        singles = sorted(plan.singles, key=lambda index: operation_lane(unique_batch[index]['operation']) != 'scalar')
+        tasks += [asyncio.ensure_future(self._with_deadline(self._run_item(index, unique_batch[index]), [index]))
+                  for index in singles]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                for unique_index, response in await next_done:
+                    for index in fan_out[unique_index]:
+                        yield index, response
+        finally:
+            # the consumer went away (e.g. a streaming client disconnected); stop outstanding work
+            for task in tasks:
+                task.cancel()
+
+    async def execute(self) -> list[Response]:
+        results: list[Optional[Response]] = [None] * len(self.query_batch)
+        async for index, response in self.iter_results():
+            results[index] = response
+        return results
 
     async def excel_date_to_datetime(self, excel_date: int) -> datetime:
         """Convert an Excel date number to a Python datetime object. Based on office platform."""
@@ -174,110 +525,44 @@ class CustomFunctionHandler:
         try:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
-            if source == 'sage_intacct':  # Add other sources as needed
-                sql = '''SELECT * FROM sage_intacct__general_ledger_by_period WHERE period_last_day between :start and :end'''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date)
-
-            elif source == 'quickbooks':
-                sql = '''SELECT * FROM quickbooks__general_ledger_by_period WHERE period_last_day between :start and :end'''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date)
-
-            elif source == 'xero':
+            if source == 'xero':
                 raise ValueError('xero does not support trial balance queries. Use profit_and_loss or balance_sheet')
-            else:
-                raise ValueError('unsupported source')
-            value = await self.tabular_query(query, schema_ref)
+            query = catalog_statement('trial_balance', source, schema_ref).bindparams(start=start_date, end=end_date)
+            value = await self.tabular_query(query, schema_ref, 'trial_balance', end_date)
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
 
+    def _profit_and_loss_statement(self, source: str, schema_ref: str, start_date: datetime,
+                                   end_date: datetime) -> Executable:
+        """The income statement query for a source; scalar P&L lookups rebuild it to find the cached statement."""
+        return catalog_statement('profit_and_loss', source, schema_ref).bindparams(start=start_date, end=end_date)
+
     async def profit_and_loss(self, schema_name: str,
                               month: int,
                               period: Literal["MTD", "QTD", "YTD"]) -> Response:
         """Returns a two-dimensional array of income statement balances for a given period."""
         start_date, end_date = await self.period_to_date_range(month, period)
         try:
-            schema_ref = self.schemas[schema_name].build_dbt_schema()
-            source = self.schemas[schema_name].source
-            if source == 'sage_intacct':  # Add other sources as needed
-                sql = '''SELECT period_date,
-                               account_no,
-                               account_title,
-                               account_type,
-                               book_id,
-                               category,
-                               classification,
-                               currency,
-                               entry_state,
-                               sum(amount) as total
-                        FROM sage_intacct__profit_and_loss
-                        WHERE period_date between :start and :end
-                        GROUP BY period_date, account_no, account_title, account_type, book_id, category, classification, currency, entry_state
-                      '''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date)
-            elif source == 'quickbooks':
-                sql = '''SELECT calendar_date,
-                               source_relation,
-                               account_class,
-                               class_id,
-                               is_sub_account,
-                               parent_account_number,
-                               parent_account_name,
-                               account_type,
-                               account_sub_type,
-                               account_number,
-                               account_id,
-                               account_name,
-                               sum(amount) as total
-                        FROM quickbooks__profit_and_loss
-                        WHERE calendar_date between :start and :end
-                        GROUP BY calendar_date, source_relation, account_class, class_id, is_sub_account, parent_account_number,
-                                 parent_account_name, account_type, account_sub_type, account_number, account_id, account_name
-                       '''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date)
-            elif source == 'xero':
-                sql = '''SELECT profit_and_loss_id, date_month, account_id, account_name, account_code, account_type, account_class, source_relation, sum(net_amount) as total 
-                         FROM xero__profit_and_loss_report
-                         WHERE date_month between :start and :end
-                         GROUP BY profit_and_loss_id, date_month, account_id, account_name, account_code, account_type, account_class, source_relation'''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date)
-            else:
-                raise ValueError('unsupported source')
-            value = await self.tabular_query(query, schema_ref)
+            value = frame_to_json(await self._profit_and_loss_frame(schema_name, start_date, end_date))
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
 
+    def _balance_sheet_statement(self, source: str, schema_ref: str, start_date: datetime) -> Executable:
+        """The balance sheet query for a source; scalar balance lookups rebuild it to find the cached statement."""
+        return catalog_statement('balance_sheet', source, schema_ref).bindparams(start_date=start_date)
+
     async def balance_sheet(self, schema_name: str,
                             month: int) -> Response:
         """Returns a two-dimensional array of balance sheet balances for a given period."""
         start_date, end_date = await self.period_to_date_range(month, "MTD")
         try:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
-            source = self.schemas[schema_name].source
-            if source == 'sage_intacct':  # Add other sources as needed
-                # define the table
-                sql = '''SELECT * FROM sage_intacct__balance_sheet WHERE period_date = :start_date'''
-                query = text(sql)
-                query.bindparams(start_date=start_date)
-            elif source == 'quickbooks':
-                sql = '''SELECT * FROM quickbooks__balance_sheet WHERE calendar_date = :start_date'''
-                query = text(sql)
-                query.bindparams(start_date=start_date)
-            elif source == 'xero':
-                sql = '''SELECT * FROM xero__balance_sheet_report WHERE date_month = :start_date'''
-                query = text(sql)
-                query.bindparams(start_date=start_date)
-            else:
-                raise ValueError('unsupported source')
-            value = await self.tabular_query(query, schema_ref)
+            query = self._balance_sheet_statement(self.schemas[schema_name].source, schema_ref, start_date)
+            value = await self.tabular_query(query, schema_ref, 'balance_sheet', _month_end(start_date))
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
@@ -310,7 +595,7 @@ class CustomFunctionHandler:
         else:
             raise ValueError('unsupported source')
         try:
-            value = await self.tabular_query(query, schema_ref)
+            value = await self.tabular_query(query, schema_ref, 'ap', end_date)
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
@@ -342,7 +627,7 @@ class CustomFunctionHandler:
         else:
             raise ValueError('unsupported source')
         try:
-            value = await self.tabular_query(query, schema_ref)
+            value = await self.tabular_query(query, schema_ref, 'ar', end_date)
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
@@ -354,25 +639,17 @@ class CustomFunctionHandler:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
             filter_col = filter_col.lower().split(' ', 1)[0]
-            if source == 'sage_intacct':  # Add other sources as needed
-                filter_val = convert_to_column_type(t_sage_intacct__balance_sheet, filter_col, filter_val)
-                sql = f'''SELECT sum(amount) FROM sage_intacct__balance_sheet WHERE period_date = :start_date and {filter_col} = :filter_val'''
-                query = text(sql)
-
-                query.bindparams(start_date=start_date, filter_val=filter_val)
-            elif source == 'quickbooks':
-                filter_val = convert_to_column_type(t_quickbooks__balance_sheet, filter_col, filter_val)
-                sql = f'''SELECT * FROM quickbooks__balance_sheet WHERE calendar_date = :start_date and {filter_col} = :filter_val'''
-                query = text(sql)
-                query.bindparams(start_date=start_date, filter_val=filter_val)
-            elif source == 'xero':
-                filter_val = convert_to_column_type(t_xero__balance_sheet_report, filter_col, filter_val)
-                sql = f'''SELECT * FROM xero__balance_sheet_report WHERE date_month = :start_date and {filter_col} = :filter_val'''
-                query = text(sql)
-                query.bindparams(start_date=start_date, filter_val=filter_val)
-            else:
+            spec = SCALAR_TABLES.get(('bs_acct', source))
+            if spec is None:
                 raise ValueError('unsupported source')
-            value = await self.scalar_query(query, schema_ref)
+            filter_val = convert_to_column_type(spec.table, filter_col, filter_val)
+            query = catalog_statement('bs_acct', source, schema_ref, 'column', filter_col)
+            query = query.bindparams(start_date=start_date, filter_val=filter_val)
+            totals = await self._totals_from_statement('bs_acct', schema_name, start_date, end_date,
+                                                       filter_col, [filter_val])
+            if totals is not None:
+                return Response(status='success', type='tabular', value=totals[str(filter_val)])
+            value = await self.scalar_query(query, schema_ref, 'bs_acct', _month_end(start_date))
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
@@ -386,38 +663,27 @@ class CustomFunctionHandler:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
             filter_col = filter_col.lower().split(' ', 1)[0]
-            if source == 'sage_intacct':  # Add other sources as needed
-                filter_val = convert_to_column_type(t_sage_intacct__profit_and_loss, filter_col, filter_val)
-                sql = f'''SELECT 
-                               sum(amount) as total
-                        FROM sage_intacct__profit_and_loss
-                        WHERE period_date between :start and :end and {filter_col} = :filter_val
-                      '''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date, filter_val=filter_val)
-            elif source == 'quickbooks':
-                filter_val = convert_to_column_type(t_quickbooks__profit_and_loss, filter_col, filter_val)
-                sql = f'''SELECT 
-                               sum(amount) as total
-                        FROM quickbooks__profit_and_loss
-                        WHERE calendar_date between :start and :end and {filter_col} = :filter_val
-                       '''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date, filter_val=filter_val)
-            elif source == 'xero':
-                sql = f'''SELECT sum(net_amount) as total 
-                         FROM xero__profit_and_loss_report
-                         WHERE date_month between :start and :end and {filter_col} = :filter_val'''
-                query = text(sql)
-                query = query.bindparams(start=start_date, end=end_date, filter_val=filter_val)
-            else:
+            spec = SCALAR_TABLES.get(('pl_acct', source))
+            if spec is None:
                 raise ValueError('unsupported source')
-            value = await self.scalar_query(query, schema_ref)
+            filter_val = convert_to_column_type(spec.table, filter_col, filter_val)
+            query = catalog_statement('pl_acct', source, schema_ref, 'column', filter_col)
+            query = query.bindparams(start=start_date, end=end_date, filter_val=filter_val)
+            totals = await self._totals_from_statement('pl_acct', schema_name, start_date, end_date,
+                                                       filter_col, [filter_val])
+            if totals is not None:
+                return Response(status='success', type='tabular', value=totals[str(filter_val)])
+            value = await self.scalar_query(query, schema_ref, 'pl_acct', end_date)
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
 
+    async def _account_type(self, source: str, schema_ref: str, account_no: str) -> Optional[str]:
+        """The type of a Sage account, cached once for both sage_acct_bal and sage_gl_detail."""
+        query = catalog_statement('account_type', source, schema_ref).bindparams(account_no=account_no)
+        return await self.scalar_query(query, schema_ref, 'account_type')
+
     async def sage_acct_bal(self, schema_name: str, entry_date: int,
                             period: Literal["MTD", "QTD", "YTD"], account_no: str, location_id: Optional[str] = None,
                             department_id: Optional[int] = None) -> Response:
@@ -426,18 +692,14 @@ class CustomFunctionHandler:
         try:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
-            sql = '''SELECT accounttype from gl_account where accountno = :account_no'''
-            query = text(sql)
-            value = await self.scalar_query(query, schema_ref)
+            value = await self._account_type(source, schema_ref, account_no)
             start_date, end_date = await self.period_to_date_range(entry_date, period)
             if value == 'balancesheet' and location_id or department_id:
                 raise ValueError('location_id and department_id are not supported for balance sheet accounts')
-            # Base query construction
-            table_map = {
-                'balancesheet': 'sage_intacct__balance_sheet',
-                'incomestatement': 'sage_intacct__general_ledger'
-            }
-            sql_base = f'''SELECT sum(amount) as total from {table_map.get(value, 'default_table')} WHERE period_date = :start_date and account_no = :account_no'''
+            if value not in ('balancesheet', 'incomestatement'):
+                raise ValueError(f'unsupported account type {value}')
+            # the balance sheet or the general ledger, by account type
+            sql_base = catalog_sql('sage_acct_bal', source, value)
 
             # Dynamic WHERE clause construction
             where_clauses = []
@@ -454,8 +716,8 @@ class CustomFunctionHandler:
             if where_clauses:
                 sql_base += ' and ' + ' and '.join(where_clauses)
 
-            query = text(sql_base).bindparams(**params)
-            value = await self.scalar_query(query, schema_ref)
+            query = qualified_text(sql_base, schema_ref).bindparams(**params)
+            value = await self.scalar_query(query, schema_ref, 'sage_acct_bal', _month_end(start_date))
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
@@ -465,11 +727,9 @@ class CustomFunctionHandler:
         try:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
-            sql = '''SELECT accounttype from gl_account where accountno = :account_no'''
-            query = text(sql)
-            value = await self.scalar_query(query, schema_ref)
+            value = await self._account_type(source, schema_ref, account_no)
             start_date, end_date = await self.period_to_date_range(entry_date, period)
-            sql_base = f'''SELECT * from sage_intacct__general_ledger WHERE period_date = :start_date and account_no = :account_no'''
+            sql_base = catalog_sql('sage_gl_detail', source)
 
             # Dynamic WHERE clause construction
             where_clauses = []
@@ -486,8 +746,8 @@ class CustomFunctionHandler:
             if where_clauses:
                 sql_base += ' and ' + ' and '.join(where_clauses)
 
-            query = text(sql_base).bindparams(**params)
-            value = await self.tabular_query(query, schema_ref)
+            query = qualified_text(sql_base, schema_ref).bindparams(**params)
+            value = await self.tabular_query(query, schema_ref, 'sage_gl_detail', _month_end(start_date))
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
@@ -497,17 +757,8 @@ class CustomFunctionHandler:
         try:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
-            if source in ('sage_intacct', 'quickbooks', 'xero'):
-                if active:
-                    sql = '''SELECT * FROM employee where active = true'''
-                    query = text(sql)
-                    query = query.bindparams(active=active)
-                else:
-                    sql = '''SELECT * FROM employee'''
-                    query = text(sql)
-            else:
-                raise ValueError('unsupported source')
-            value = await self.tabular_query(query, schema_ref)
+            query = catalog_statement('employee', source, schema_ref, 'active' if active else 'all')
+            value = await self.tabular_query(query, schema_ref, 'employee')
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
@@ -518,23 +769,8 @@ class CustomFunctionHandler:
         try:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
-            if source in ('sage_intacct', 'quickbooks'):
-                if active:
-                    sql = '''SELECT * FROM vendor where active = true'''
-                    query = text(sql)
-                else:
-                    sql = '''SELECT * FROM vendor'''
-                    query = text(sql)
-            elif source == 'xero':
-                if active:
-                    sql = '''SELECT * FROM contact where is_supplier = true and is_customer = false and contact_status = 'ACTIVE' '''
-                    query = text(sql)
-                else:
-                    sql = '''SELECT * FROM contact where is_supplier = true and is_customer = false'''
-                    query = text(sql)
-            else:
-                raise ValueError('unsupported source')
-            value = await self.tabular_query(query, schema_ref)
+            query = catalog_statement('vendor', source, schema_ref, 'active' if active else 'all')
+            value = await self.tabular_query(query, schema_ref, 'vendor')
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
@@ -545,23 +781,8 @@ class CustomFunctionHandler:
         try:
             schema_ref = self.schemas[schema_name].build_dbt_schema()
             source = self.schemas[schema_name].source
-            if source in ('sage_intacct', 'quickbooks'):
-                if active:
-                    sql = '''SELECT * FROM customer where active = true'''
-                    query = text(sql)
-                else:
-                    sql = '''SELECT * FROM customer'''
-                    query = text(sql)
-            elif source == 'xero':
-                if active:
-                    sql = '''SELECT * FROM contact where is_supplier = true and is_customer = false and contact_status = 'ACTIVE' '''
-                    query = text(sql)
-                else:
-                    sql = '''SELECT * FROM contact where is_supplier = true and is_customer = false'''
-                    query = text(sql)
-            else:
-                raise ValueError('unsupported source')
-            value = await self.tabular_query(query, schema_ref)
+            query = catalog_statement('customer', source, schema_ref, 'active' if active else 'all')
+            value = await self.tabular_query(query, schema_ref, 'customer')
             return Response(status='success', type='tabular', value=value)
 
         except Exception as e:
@@ -569,31 +790,11 @@ class CustomFunctionHandler:
 
     async def accts(self, schema_name: str, active: bool) -> Response:
         """returns a two-dimensional array of accounts for intacct"""
-        schema_ref = self.schemas[schema_name].build_dbt_schema()
-        source = self.schemas[schema_name].source
         try:
-            if source == 'sage_intacct':
-                if active:
-                    sql = '''SELECT * FROM gl_account where status = 'active' '''
-                    query = text(sql)
-                else:
-                    sql = '''SELECT * FROM gl_account'''
-                    query = text(sql)
-            elif source == 'quickbooks':
-                if active:
-                    sql = '''SELECT * FROM account where active = true'''
-                    query = text(sql)
-                else:
-                    sql = '''SELECT * FROM account'''
-                    query = text(sql)
-            elif source == 'xero':
-                if active:
-                    sql = '''SELECT * FROM account where status = 'ACTIVE' '''
-                    query = text(sql)
-                else:
-                    sql = '''SELECT * FROM account'''
-                    query = text(sql)
-            value = await self.tabular_query(query, schema_ref)
+            schema_ref = self.schemas[schema_name].build_dbt_schema()
+            source = self.schemas[schema_name].source
+            query = catalog_statement('accts', source, schema_ref, 'active' if active else 'all')
+            value = await self.tabular_query(query, schema_ref, 'accts')
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
@@ -601,20 +802,20 @@ class CustomFunctionHandler:
     async def get_table(self, schema_name, table_name: str) -> Response:
         """Returns a two-dimensional array of the selected object for a given period."""
         # TODO add table validation to prevent sql injection
-        tbl = table(table_name)
+        tbl = table(table_name, schema=schema_name.lower())
         query = select(text('*'), tbl)
         try:
-            value = await self.tabular_query(query, schema_name)
+            value = await self.tabular_query(query, schema_name, 'get_table')
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
 
     async def get_objects(self, schema_name: str) -> Response:
         """Returns a list of objects available for querying."""
-        tbl = table('tables')
+        tbl = table('tables', schema='information_schema')
         query = select(text('table_name'), tbl).where(column('table_schema').__eq__(schema_name))
         try:
-            value = await self.tabular_query(query, 'information_schema')
+            value = await self.tabular_query(query, 'information_schema', 'get_objects')
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
@@ -622,9 +823,9 @@ class CustomFunctionHandler:
     async def get_schemas(self) -> Response:
         """Returns a list of schemas available for querying."""
         try:
-            tbl = table('schemata')
+            tbl = table('schemata', schema='information_schema')
             query = select(text('schema_name'), tbl)
-            value = await self.tabular_query(query, 'information_schema')
+            value = await self.tabular_query(query, 'information_schema', 'get_schemas')
             return Response(status='success', type='tabular', value=value)
         except Exception as e:
             return Response(status='error', type='scalar', value=str(e))
@@ -0,0 +1,37 @@
+import time
+
+from app.config import settings as global_settings
+from app.services.singleflight import warehouse_flights
+
+# schema generation as last seen by this worker: (tenant_db, schema_ref) -> (version, probe expiry)
+_probes: dict[tuple[str, str], tuple[str, float]] = {}
+
+
+def version_key(tenant_db: str, schema_ref: str) -> str:
+    return f"xqf:version:{tenant_db}:{schema_ref}"
+
+
+async def get_data_version(redis, tenant_db: str, schema_ref: str) -> str:
+    """
+    Returns the data generation of a schema. It is part of every cache key, so cached results stay valid
+    until a sync bumps it. The probe is kept in-process for data_version_ttl seconds.
+    """
+    probe = _probes.get((tenant_db, schema_ref))
+    if probe is not None and probe[1] > time.monotonic():
+        return probe[0]
+    # the items of a batch miss together, so they share one GET
+    return await warehouse_flights.do(f'version:{tenant_db}:{schema_ref}',
+                                      lambda: _probe_version(redis, tenant_db, schema_ref))
+
+
+async def _probe_version(redis, tenant_db: str, schema_ref: str) -> str:
+    version = await redis.get(version_key(tenant_db, schema_ref)) or '0'
+    _probes[(tenant_db, schema_ref)] = (version, time.monotonic() + global_settings.data_version_ttl)
+    return version
+
+
+async def bump_data_version(redis, tenant_db: str, schema_ref: str) -> int:
+    """Starts a new data generation for a schema after its Fivetran sync has landed."""
+    version = await redis.incr(version_key(tenant_db, schema_ref))
+    _probes.pop((tenant_db, schema_ref), None)
+    return version
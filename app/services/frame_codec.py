@@ -0,0 +1,127 @@
+import json
+import struct
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+# frame := FRAME_MAGIC, version byte, uint32 header length, JSON header, column buffers back to back
+FRAME_MAGIC = b'XF'
+FRAME_VERSION = 2
+# version 1 frames have no decimal columns and are still read
+_READABLE_VERSIONS = (1, FRAME_VERSION)
+_PREFIX = struct.Struct('<2sBI')
+_NAT = np.iinfo(np.int64).min
+
+
+def _json_buffer(values: list) -> bytes:
+    return json.dumps(values, default=str, separators=(',', ':')).encode('utf-8')
+
+
+def _encode_object_column(values: np.ndarray, mask: np.ndarray) -> tuple[dict, list[bytes]]:
+    """Picks a typed layout for an object column from the python types of its non-null values."""
+    present = values[~mask]
+    if len(present) and all(isinstance(v, Decimal) for v in present):
+        # numeric columns keep their exact values and scale, so totals summed from a frame render as Postgres does
+        return {'kind': 'decimal'}, [_json_buffer([None if m else str(v) for v, m in zip(values, mask, strict=True)])]
+    if len(present) and all(isinstance(v, (Decimal, float)) for v in present):
+        # Decimal totals become float64, exactly what DataFrame.to_json already sent to the add-in
+        floats = np.array([np.nan if m else float(v) for v, m in zip(values, mask, strict=True)], dtype='<f8')
+        return {'kind': 'float'}, [floats.tobytes()]
+    if len(present) and all(isinstance(v, date) and not isinstance(v, datetime) for v in present):
+        days = np.array([_NAT if m else v.toordinal() for v, m in zip(values, mask, strict=True)], dtype='<i8')
+        return {'kind': 'date'}, [days.tobytes()]
+    if len(present) and all(isinstance(v, str) for v in present):
+        # repeated strings (account names, types, locations) are stored once in a dictionary
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        return {'kind': 'dict'}, [codes.astype('<i4').tobytes(), _json_buffer(list(uniques))]
+    # DataFrame.to_json renders Decimals in mixed columns as floats, so the JSON layout keeps doing so
+    return {'kind': 'json'}, [_json_buffer([None if m else float(v) if isinstance(v, Decimal) else v
+                                            for v, m in zip(values, mask, strict=True)])]
+
+
+def _encode_column(series: pd.Series) -> tuple[dict, list[bytes]]:
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return {'kind': 'bool'}, [series.to_numpy(dtype=np.bool_).tobytes()]
+    if pd.api.types.is_integer_dtype(dtype):
+        return {'kind': 'int'}, [series.to_numpy(dtype='<i8').tobytes()]
+    if pd.api.types.is_float_dtype(dtype):
+        return {'kind': 'float'}, [series.to_numpy(dtype='<f8').tobytes()]
+    if isinstance(dtype, pd.DatetimeTZDtype):
+        nanos = series.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy(dtype='datetime64[ns]').view('<i8')
+        return {'kind': 'datetime', 'tz': str(dtype.tz)}, [nanos.tobytes()]
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return {'kind': 'datetime', 'tz': None}, [series.to_numpy(dtype='datetime64[ns]').view('<i8').tobytes()]
+    values = series.to_numpy(dtype=object)
+    return _encode_object_column(values, pd.isna(series).to_numpy())
+
+
+def _decode_column(meta: dict, buffers: list[bytes]) -> Any:
+    kind = meta['kind']
+    if kind == 'bool':
+        return np.frombuffer(buffers[0], dtype=np.bool_)
+    if kind == 'int':
+        return np.frombuffer(buffers[0], dtype='<i8')
+    if kind == 'float':
+        return np.frombuffer(buffers[0], dtype='<f8')
+    if kind == 'datetime':
+        values = pd.DatetimeIndex(np.frombuffer(buffers[0], dtype='<i8').view('datetime64[ns]'))
+        return values.tz_localize('UTC').tz_convert(meta['tz']) if meta['tz'] else values
+    if kind == 'date':
+        days = np.frombuffer(buffers[0], dtype='<i8')
+        return pd.to_datetime([None if d == _NAT else date.fromordinal(int(d)) for d in days])
+    if kind == 'decimal':
+        return np.array([None if v is None else Decimal(v) for v in json.loads(bytes(buffers[0]))], dtype=object)
+    if kind == 'dict':
+        codes = np.frombuffer(buffers[0], dtype='<i4')
+        dictionary = np.array(json.loads(bytes(buffers[1])) + [None], dtype=object)
+        # code -1 (null) picks the trailing None
+        return dictionary[codes]
+    if kind == 'json':
+        return np.array(json.loads(bytes(buffers[0])), dtype=object)
+    raise ValueError(f'unsupported frame column kind {kind}')
+
+
+def encode_frame(df: pd.DataFrame) -> bytes:
+    """
+    Serialises a query result into the internal columnar format: one typed array per column,
+    with string columns dictionary-encoded and numeric columns kept as exact decimals.
+    """
+    columns = []
+    buffers = []
+    for position, name in enumerate(df.columns):
+        meta, column_buffers = _encode_column(df.iloc[:, position])
+        meta['name'] = name
+        meta['sizes'] = [len(buffer) for buffer in column_buffers]
+        columns.append(meta)
+        buffers.extend(column_buffers)
+    header = json.dumps({'rows': len(df), 'columns': columns}, default=str, separators=(',', ':')).encode('utf-8')
+    return b''.join([_PREFIX.pack(FRAME_MAGIC, FRAME_VERSION, len(header)), header, *buffers])
+
+
+def decode_frame(data: bytes) -> pd.DataFrame:
+    magic, version, header_size = _PREFIX.unpack_from(data)
+    if magic != FRAME_MAGIC or version not in _READABLE_VERSIONS:
+        raise ValueError(f'unsupported frame {magic!r} version {version}')
+    offset = _PREFIX.size
+    header = json.loads(data[offset:offset + header_size])
+    offset += header_size
+    view = memoryview(data)
+    arrays = {}
+    for position, meta in enumerate(header['columns']):
+        column_buffers = []
+        for size in meta['sizes']:
+            column_buffers.append(view[offset:offset + size])
+            offset += size
+        arrays[position] = _decode_column(meta, column_buffers)
+    df = pd.DataFrame(arrays, index=pd.RangeIndex(header['rows']))
+    df.columns = [meta['name'] for meta in header['columns']]
+    return df
+
+
+def frame_to_json(df: pd.DataFrame) -> str:
+    """The response edge: the JSON layout the add-in reads tabular results in."""
+    return df.to_json(orient='split', date_format='iso')
@@ -0,0 +1,131 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Hashable
+
+from app.config import settings as global_settings
+
+
+class TenantScheduler:
+    """
+    Caps the number of warehouse calls a tenant runs at once across all requests in this process.
+
+    Waiters are queued per batch and slots are handed out round-robin between batches, so a 500 item
+    recalc cannot starve a 5 item refresh that arrives a moment later.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._queues: OrderedDict[Hashable, deque[asyncio.Future]] = OrderedDict()
+        self.acquired = 0
+        self.queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _wake_next(self) -> None:
+        while self._queues and self.active < self.limit:
+            batch_key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                # more work from this batch goes to the back of the line
+                self._queues.move_to_end(batch_key)
+            else:
+                del self._queues[batch_key]
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    async def acquire(self, batch_key: Hashable) -> float:
+        """Waits for a slot and returns the seconds spent queued."""
+        started = time.monotonic()
+        if self.active >= self.limit or self._queues:
+            waiter = asyncio.get_running_loop().create_future()
+            self._queues.setdefault(batch_key, deque()).append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # the slot was handed over just as we were cancelled
+                    self.release()
+                else:
+                    queue = self._queues.get(batch_key)
+                    if queue and waiter in queue:
+                        queue.remove(waiter)
+                        if not queue:
+                            del self._queues[batch_key]
+                raise
+        else:
+            self.active += 1
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.queue_wait += waited
+        self.max_queue_wait = max(self.max_queue_wait, waited)
+        return waited
+
+    def release(self) -> None:
+        self.active -= 1
+        self._wake_next()
+
+    def stats(self) -> dict:
+        return {
+            'limit': self.limit,
+            'active': self.active,
+            'waiting': self.waiting,
+            'acquired': self.acquired,
+            'queue_wait_total': round(self.queue_wait, 6),
+            'queue_wait_max': round(self.max_queue_wait, 6),
+        }
+
+
+# latency-critical cell functions run in their own lane so bulk pulls can never starve them
+SCALAR_OPERATIONS = frozenset({'bs_acct', 'pl_acct', 'sage_acct_bal'})
+LANES = ('scalar', 'bulk')
+
+
+def operation_lane(operation: str) -> str:
+    return 'scalar' if operation in SCALAR_OPERATIONS else 'bulk'
+
+
+def lane_limit(lane: str) -> int:
+    if lane == 'scalar':
+        return global_settings.scalar_lane_concurrency
+    return global_settings.bulk_lane_concurrency
+
+
+tenant_schedulers: dict[tuple[str, str], TenantScheduler] = {}
+
+
+def get_tenant_scheduler(tenant_db: str, lane: str = 'scalar') -> TenantScheduler:
+    if (tenant_db, lane) not in tenant_schedulers:
+        tenant_schedulers[(tenant_db, lane)] = TenantScheduler(lane_limit(lane))
+    return tenant_schedulers[(tenant_db, lane)]
+
+
+class BatchScheduler:
+    """
+    Per-request view of a tenant's lanes: bounds each lane of one batch and accumulates its queue-wait time.
+    """
+
+    def __init__(self, tenant_db: str, limit: int):
+        self.lanes = {lane: (get_tenant_scheduler(tenant_db, lane), asyncio.Semaphore(limit)) for lane in LANES}
+        self.queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    @asynccontextmanager
+    async def slot(self, lane: str = 'scalar') -> AsyncIterator[None]:
+        tenant, semaphore = self.lanes[lane]
+        started = time.monotonic()
+        async with semaphore:
+            await tenant.acquire(id(self))
+            try:
+                waited = time.monotonic() - started
+                self.queue_wait += waited
+                self.max_queue_wait = max(self.max_queue_wait, waited)
+                yield
+            finally:
+                tenant.release()
@@ -0,0 +1,28 @@
+import functools
+import re
+
+from sqlalchemy import TextClause, text
+from sqlalchemy.dialects import postgresql
+
+_preparer = postgresql.dialect().identifier_preparer
+# plain postgres identifiers only; anything else never reaches the SQL text
+_SCHEMA_NAME = re.compile(r'[A-Za-z_][A-Za-z0-9_$]{0,62}')
+
+
+def quote_schema(schema_ref: str) -> str:
+    """
+    Returns a schema name as a quoted SQL qualifier. Names are folded to lower case first, as search_path did
+    with the unquoted names it was given, and anything that is not a plain identifier is rejected.
+    """
+    if not isinstance(schema_ref, str) or not _SCHEMA_NAME.fullmatch(schema_ref):
+        raise ValueError(f'invalid schema name {schema_ref!r}')
+    return _preparer.quote(schema_ref.lower())
+
+
+@functools.lru_cache(maxsize=4096)
+def qualified_text(sql: str, schema_ref: str) -> TextClause:
+    """
+    text() of a SQL template whose tables are written as {schema}.table, qualified with the quoted schema.
+    Templates are parsed once per schema; bindparams() returns a copy, so the cached clause is never changed.
+    """
+    return text(sql.replace('{schema}', quote_schema(schema_ref)))
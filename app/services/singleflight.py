@@ -0,0 +1,56 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class SingleFlight:
+    """
+    Collapses identical in-flight calls in this process.
+
+    The first caller for a key starts the work in its own task; callers arriving while it runs await
+    the same task instead of repeating the query. The task is shielded, so a caller hitting its own
+    deadline does not cancel the work the others are waiting on, but once the last caller has gone
+    the task is cancelled, which cancels its warehouse query as well.
+    """
+
+    def __init__(self):
+        self._flights: dict[str, asyncio.Task] = {}
+        # callers still awaiting each task
+        self._waiters: dict[asyncio.Task, int] = {}
+        self.executed = 0
+        self.collapsed = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def _land(self, key: str, task: asyncio.Task) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # mark the exception as retrieved even if every caller already gave up
+            task.exception()
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._land(key, done))
+            self.executed += 1
+        else:
+            self.collapsed += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        return {'executed': self.executed, 'collapsed': self.collapsed, 'in_flight': self.in_flight}
+
+
+warehouse_flights = SingleFlight()
@@ -0,0 +1,142 @@
+import functools
+import re
+from typing import Optional
+
+from sqlalchemy import TextClause
+
+from app.services.schema_sql import qualified_text
+
+_COLUMN_NAME = re.compile(r'[a-z_][a-z0-9_]*')
+
+# (function, source, variant) -> SQL template, tables written as {schema}.table.
+# Templates are fixed text, so asyncpg prepares each (template, schema) once per connection and reuses the plan.
+TEMPLATES: dict[tuple[str, str, Optional[str]], str] = {
+    ('trial_balance', 'sage_intacct', None):
+        '''SELECT * FROM {schema}.sage_intacct__general_ledger_by_period WHERE period_last_day between :start and :end''',
+    ('trial_balance', 'quickbooks', None):
+        '''SELECT * FROM {schema}.quickbooks__general_ledger_by_period WHERE period_last_day between :start and :end''',
+
+    ('profit_and_loss', 'sage_intacct', None):
+        '''SELECT period_date,
+                  account_no,
+                  account_title,
+                  account_type,
+                  book_id,
+                  category,
+                  classification,
+                  currency,
+                  entry_state,
+                  sum(amount) as total
+           FROM {schema}.sage_intacct__profit_and_loss
+           WHERE period_date between :start and :end
+           GROUP BY period_date, account_no, account_title, account_type, book_id, category, classification, currency, entry_state''',
+    ('profit_and_loss', 'quickbooks', None):
+        '''SELECT calendar_date,
+                  source_relation,
+                  account_class,
+                  class_id,
+                  is_sub_account,
+                  parent_account_number,
+                  parent_account_name,
+                  account_type,
+                  account_sub_type,
+                  account_number,
+                  account_id,
+                  account_name,
+                  sum(amount) as total
+           FROM {schema}.quickbooks__profit_and_loss
+           WHERE calendar_date between :start and :end
+           GROUP BY calendar_date, source_relation, account_class, class_id, is_sub_account, parent_account_number,
+                    parent_account_name, account_type, account_sub_type, account_number, account_id, account_name''',
+    ('profit_and_loss', 'xero', None):
+        '''SELECT profit_and_loss_id, date_month, account_id, account_name, account_code, account_type, account_class, source_relation, sum(net_amount) as total
+           FROM {schema}.xero__profit_and_loss_report
+           WHERE date_month between :start and :end
+           GROUP BY profit_and_loss_id, date_month, account_id, account_name, account_code, account_type, account_class, source_relation''',
+
+    ('balance_sheet', 'sage_intacct', None):
+        '''SELECT * FROM {schema}.sage_intacct__balance_sheet WHERE period_date = :start_date''',
+    ('balance_sheet', 'quickbooks', None):
+        '''SELECT * FROM {schema}.quickbooks__balance_sheet WHERE calendar_date = :start_date''',
+    ('balance_sheet', 'xero', None):
+        '''SELECT * FROM {schema}.xero__balance_sheet_report WHERE date_month = :start_date''',
+
+    # the column variants take the filter column, one prepared statement per column
+    ('bs_acct', 'sage_intacct', 'column'):
+        '''SELECT sum(amount) FROM {schema}.sage_intacct__balance_sheet WHERE period_date = :start_date and {column} = :filter_val''',
+    ('bs_acct', 'quickbooks', 'column'):
+        '''SELECT sum(amount) FROM {schema}.quickbooks__balance_sheet WHERE calendar_date = :start_date and {column} = :filter_val''',
+    ('bs_acct', 'xero', 'column'):
+        '''SELECT sum(net_amount) FROM {schema}.xero__balance_sheet_report WHERE date_month = :start_date and {column} = :filter_val''',
+    ('pl_acct', 'sage_intacct', 'column'):
+        '''SELECT sum(amount) as total FROM {schema}.sage_intacct__profit_and_loss
+           WHERE period_date between :start and :end and {column} = :filter_val''',
+    ('pl_acct', 'quickbooks', 'column'):
+        '''SELECT sum(amount) as total FROM {schema}.quickbooks__profit_and_loss
+           WHERE calendar_date between :start and :end and {column} = :filter_val''',
+    ('pl_acct', 'xero', 'column'):
+        '''SELECT sum(net_amount) as total FROM {schema}.xero__profit_and_loss_report
+           WHERE date_month between :start and :end and {column} = :filter_val''',
+
+    ('account_type', 'sage_intacct', None):
+        '''SELECT accounttype from {schema}.gl_account where accountno = :account_no''',
+    # variant: the account type of the account, which decides the table its balance is read from
+    ('sage_acct_bal', 'sage_intacct', 'balancesheet'):
+        '''SELECT sum(amount) as total from {schema}.sage_intacct__balance_sheet WHERE period_date = :start_date and account_no = :account_no''',
+    ('sage_acct_bal', 'sage_intacct', 'incomestatement'):
+        '''SELECT sum(amount) as total from {schema}.sage_intacct__general_ledger WHERE period_date = :start_date and account_no = :account_no''',
+    ('sage_gl_detail', 'sage_intacct', None):
+        '''SELECT * from {schema}.sage_intacct__general_ledger WHERE period_date = :start_date and account_no = :account_no''',
+
+    ('employee', 'sage_intacct', 'active'): '''SELECT * FROM {schema}.employee where active = true''',
+    ('employee', 'sage_intacct', 'all'): '''SELECT * FROM {schema}.employee''',
+    ('employee', 'quickbooks', 'active'): '''SELECT * FROM {schema}.employee where active = true''',
+    ('employee', 'quickbooks', 'all'): '''SELECT * FROM {schema}.employee''',
+    ('employee', 'xero', 'active'): '''SELECT * FROM {schema}.employee where active = true''',
+    ('employee', 'xero', 'all'): '''SELECT * FROM {schema}.employee''',
+
+    ('vendor', 'sage_intacct', 'active'): '''SELECT * FROM {schema}.vendor where active = true''',
+    ('vendor', 'sage_intacct', 'all'): '''SELECT * FROM {schema}.vendor''',
+    ('vendor', 'quickbooks', 'active'): '''SELECT * FROM {schema}.vendor where active = true''',
+    ('vendor', 'quickbooks', 'all'): '''SELECT * FROM {schema}.vendor''',
+    ('vendor', 'xero', 'active'):
+        '''SELECT * FROM {schema}.contact where is_supplier = true and is_customer = false and contact_status = 'ACTIVE' ''',
+    ('vendor', 'xero', 'all'): '''SELECT * FROM {schema}.contact where is_supplier = true and is_customer = false''',
+
+    ('customer', 'sage_intacct', 'active'): '''SELECT * FROM {schema}.customer where active = true''',
+    ('customer', 'sage_intacct', 'all'): '''SELECT * FROM {schema}.customer''',
+    ('customer', 'quickbooks', 'active'): '''SELECT * FROM {schema}.customer where active = true''',
+    ('customer', 'quickbooks', 'all'): '''SELECT * FROM {schema}.customer''',
+    ('customer', 'xero', 'active'):
+        '''SELECT * FROM {schema}.contact where is_supplier = true and is_customer = false and contact_status = 'ACTIVE' ''',
+    ('customer', 'xero', 'all'): '''SELECT * FROM {schema}.contact where is_supplier = true and is_customer = false''',
+
+    ('accts', 'sage_intacct', 'active'): '''SELECT * FROM {schema}.gl_account where status = 'active' ''',
+    ('accts', 'sage_intacct', 'all'): '''SELECT * FROM {schema}.gl_account''',
+    ('accts', 'quickbooks', 'active'): '''SELECT * FROM {schema}.account where active = true''',
+    ('accts', 'quickbooks', 'all'): '''SELECT * FROM {schema}.account''',
+    ('accts', 'xero', 'active'): '''SELECT * FROM {schema}.account where status = 'ACTIVE' ''',
+    ('accts', 'xero', 'all'): '''SELECT * FROM {schema}.account''',
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def catalog_sql(function: str, source: str, variant: Optional[str] = None, column: Optional[str] = None) -> str:
+    """
+    The SQL template of a function for a source, with the filter column filled in for the column variants.
+    The column is spliced into the text, so only plain lower case column names are accepted.
+    """
+    sql = TEMPLATES.get((function, source, variant))
+    if sql is None:
+        raise ValueError('unsupported source')
+    if '{column}' in sql:
+        if column is None or not _COLUMN_NAME.fullmatch(column):
+            raise ValueError(f'invalid filter column {column!r}')
+        sql = sql.replace('{column}', column)
+    return sql
+
+
+def catalog_statement(function: str, source: str, schema_ref: str, variant: Optional[str] = None,
+                      column: Optional[str] = None) -> TextClause:
+    """The catalog statement qualified with schema_ref, parsed once per process; bind it with bindparams()."""
+    return qualified_text(catalog_sql(function, source, variant, column), schema_ref)
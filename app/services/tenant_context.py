@@ -0,0 +1,48 @@
+import dataclasses
+import time
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import settings as global_settings
+from app.models.fivetranschema import FivetranSchema
+from app.services.custom_function_handler import build_schemas
+
+
+@dataclasses.dataclass(frozen=True)
+class TenantContext:
+    """Everything a batch needs to know about its tenant from the app database."""
+    tenant_id: int
+    tenant_db: str
+    schemas: dict[str, FivetranSchema]
+
+
+# tenant_id -> (context, generation it was loaded under, expiry)
+_contexts: dict[int, tuple[TenantContext, str, float]] = {}
+
+
+def generation_key(tenant_id: int) -> str:
+    return f"xqf:tenant_context:{tenant_id}"
+
+
+async def get_tenant_context(db_session: AsyncSession, redis, tenant_id: int, tenant_db: str) -> TenantContext:
+    """
+    Returns the tenant's context, loading it from the app database at most once per tenant_context_ttl.
+    The load runs in its own short transaction, so the app-DB connection is back in the pool before any
+    warehouse work starts. A Redis generation lets invalidate_tenant_context reach every worker.
+    """
+    generation = await redis.get(generation_key(tenant_id)) or '0'
+    entry = _contexts.get(tenant_id)
+    if entry is not None and entry[1] == generation and entry[2] > time.monotonic():
+        return entry[0]
+    async with db_session.begin():
+        schemas = await build_schemas(db_session, tenant_id)
+    context = TenantContext(tenant_id, tenant_db, schemas)
+    _contexts[tenant_id] = (context, generation, time.monotonic() + global_settings.tenant_context_ttl)
+    return context
+
+
+async def invalidate_tenant_context(redis, tenant_id: int) -> int:
+    """Drops the tenant's cached context in every worker, e.g. after a schema was added or deactivated."""
+    generation = await redis.incr(generation_key(tenant_id))
+    _contexts.pop(tenant_id, None)
+    return generation
@@ -0,0 +1,73 @@
+import time
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio.Redis (decode_responses=True) for the cache paths."""
+
+    def __init__(self):
+        self.data: dict[str, tuple[str, float | None]] = {}
+
+    def _live(self, key: str):
+        value = self.data.get(key)
+        if value is None:
+            return None
+        if value[1] is not None and value[1] <= time.monotonic():
+            del self.data[key]
+            return None
+        return value[0]
+
+    async def get(self, key: str):
+        return self._live(key)
+
+    async def mget(self, keys: list[str]):
+        return [self._live(key) for key in keys]
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    async def set(self, key: str, value, ex=None, px=None, nx=False):
+        if nx and self._live(key) is not None:
+            return None
+        ttl = ex if ex is not None else (px / 1000 if px is not None else None)
+        self.data[key] = (value, None if ttl is None else time.monotonic() + ttl)
+        return True
+
+    async def incr(self, key: str) -> int:
+        value = int(self._live(key) or 0) + 1
+        self.data[key] = (str(value), self.data.get(key, (None, None))[1])
+        return value
+
+    async def exists(self, key: str) -> int:
+        return int(self._live(key) is not None)
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def eval(self, script: str, numkeys: int, key: str, token: str) -> int:
+        # only the compare-and-delete lease release is used
+        if self._live(key) == token:
+            return await self.delete(key)
+        return 0
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.commands = []
+
+    def mget(self, keys: list[str]):
+        self.commands.append(("mget", (keys,), {}))
+        return self
+
+    def set(self, key: str, value, ex=None):
+        self.commands.append(("set", (key, value), {"ex": ex}))
+        return self
+
+    async def execute(self):
+        return [await getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
@@ -0,0 +1,20 @@
+class FakeConnection:
+    """Just enough of AsyncConnection for apply_statement_timeout; records the settings statements it runs."""
+
+    def __init__(self):
+        self.info: dict = {}
+        self.settings: list[str] = []
+
+    async def execute(self, stmt):
+        self.settings.append(str(stmt.compile(compile_kwargs={"literal_binds": True})))
+
+
+class FakeConnectionSession:
+    """Mixin for fake warehouse sessions: every session of one fake shares a single pooled connection."""
+
+    wh_connection = None
+
+    async def connection(self, execution_options=None) -> FakeConnection:
+        if self.wh_connection is None:
+            self.wh_connection = FakeConnection()
+        return self.wh_connection
@@ -0,0 +1,68 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app.models.fivetranschema import FivetranSchema
+from app.services.batch_planner import dedupe_batch, plan_batch
+
+pytestmark = pytest.mark.anyio
+
+schemas = {
+    "acme": FivetranSchema(schema_name="acme", source="sage_intacct"),
+    "books": FivetranSchema(schema_name="books", source="quickbooks"),
+}
+
+
+async def month_range(excel_date: int, period: str) -> tuple[datetime, datetime]:
+    return datetime(2024, excel_date, 1), datetime(2024, excel_date, 28)
+
+
+def bs_acct(schema_name: str, month: int, filter_val: str, filter_col: str = "account_no") -> dict:
+    return {"operation": "bs_acct",
+            "args": {"schema_name": schema_name, "month": month, "filter_col": filter_col, "filter_val": filter_val}}
+
+
+async def test_plan_batch_groups_same_table_calls():
+    batch = [bs_acct("acme", 1, "1000"), bs_acct("acme", 1, "2000"), bs_acct("acme", 1, "1000"),
+             bs_acct("acme", 2, "1000"), {"operation": "vendor", "args": {"schema_name": "acme"}}]
+    plan = await plan_batch(batch, schemas, month_range)
+    assert len(plan.groups) == 1
+    assert plan.groups[0].members == [(0, "1000"), (1, "2000"), (2, "1000")]
+    assert plan.groups[0].filter_vals == ["1000", "2000"]
+    assert plan.singles == [3, 4]
+
+
+async def test_plan_batch_leaves_unresolvable_calls_single():
+    batch = [bs_acct("missing", 1, "1000"), bs_acct("missing", 1, "2000"),
+             {"operation": "bs_acct", "args": {"schema_name": "acme", "month": 1, "filter_col": "nope",
+                                               "filter_val": "1"}}]
+    plan = await plan_batch(batch, schemas, month_range)
+    assert plan.groups == []
+    assert plan.singles == [0, 1, 2]
+
+
+async def test_group_statement_uses_any():
+    batch = [bs_acct("books", 1, "1000", "account_number"), bs_acct("books", 1, "2000", "Account_Number (GL)")]
+    plan = await plan_batch(batch, schemas, month_range)
+    sql = str(plan.groups[0].statement().compile(dialect=postgresql.dialect()))
+    assert "quickbooks__balance_sheet.account_number = ANY (%(filter_vals)s::TEXT[])" in sql
+    assert "GROUP BY quickbooks__balance_sheet.account_number" in sql
+
+
+class Handler:
+    async def vendor(self, schema_name: str, active: bool = True):
+        pass
+
+
+def test_dedupe_batch_normalizes_args_by_type():
+    batch = [{"operation": "vendor", "args": {"schema_name": "acme", "active": "1"}},
+             {"operation": "vendor", "args": {"schema_name": "acme"}},
+             {"operation": "vendor", "args": {"schema_name": "acme", "active": "false"}},
+             {"operation": "vendor", "args": {"schema_name": "acme", "active": True}},
+             {"operation": "vendor", "args": {"nope": 1}}]
+    unique_batch, fan_out = dedupe_batch(batch, Handler())
+    assert unique_batch[:2] == [{"operation": "vendor", "args": {"schema_name": "acme", "active": True}},
+                                {"operation": "vendor", "args": {"schema_name": "acme", "active": False}}]
+    assert unique_batch[2] is batch[4]
+    assert fan_out == [[0, 1, 3], [2], [4]]
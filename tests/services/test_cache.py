@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from app.services.cache import LocalCache, TieredCache, fresh_key
+from app.services.cache_codec import decode_value, encode_value
+from tests.services.fake_redis import FakeRedis
+
+pytestmark = pytest.mark.anyio
+
+
+def test_local_cache_evicts_least_recently_used_by_bytes():
+    cache = LocalCache(max_bytes=10)
+    cache.set("a", "aaaa", ttl=60)
+    cache.set("b", "bbbb", ttl=60)
+    assert cache.get("a") == "aaaa"
+    cache.set("c", "cccc", ttl=60)
+    assert cache.get("b") is None
+    assert cache.get("a") == "aaaa"
+    assert cache.size == 8
+
+
+def test_local_cache_counts_text_by_its_utf8_size():
+    cache = LocalCache(max_bytes=10)
+    cache.set("a", "€€€", ttl=60)
+    assert cache.size == 9
+    cache.set("b", "ü", ttl=60)
+    assert cache.get("a") is None
+    assert cache.size == 2
+
+
+def test_local_cache_expires_entries():
+    cache = LocalCache(max_bytes=10)
+    cache.set("a", "aaaa", ttl=0)
+    assert cache.get("a") is None
+    assert cache.size == 0
+
+
+async def test_tiered_cache_writes_through_and_fills_from_redis():
+    redis = FakeRedis()
+    cache = TieredCache(redis, LocalCache(max_bytes=100))
+    await cache.set("a", "value", ex=60)
+    assert decode_value(await redis.get("a")) == "value"
+    await redis.set("b", "from redis")
+    await redis.set(fresh_key("b"), b"1")
+    assert await cache.get("b") == "from redis"
+    await redis.delete("b")
+    assert await cache.get("b") == "from redis"
+    assert cache.local.stats()["hits"] == 1
+
+
+async def test_tiered_cache_coalesces_concurrent_reads_and_writes():
+    redis = FakeRedis()
+    await redis.set("a", "1")
+    await redis.set("b", "2")
+    cache = TieredCache(redis, LocalCache(max_bytes=100))
+    values = await asyncio.gather(cache.get("a"), cache.get("b"), cache.get("c"))
+    assert values == ["1", "2", None]
+    assert cache.round_trips == 1
+    await asyncio.gather(cache.set("c", "3", ex=60), cache.set("d", "4", ex=60))
+    assert cache.round_trips == 2
+    assert [decode_value(value) for value in await redis.mget(["c", "d"])] == ["3", "4"]
+
+
+async def test_values_past_their_soft_ttl_are_served_as_stale():
+    redis = FakeRedis()
+    cache = TieredCache(redis, LocalCache(max_bytes=100))
+    await cache.set("a", "value", ex=60, soft_ex=30)
+    assert redis.data[fresh_key("a")][1] < redis.data["a"][1]
+    cache.local = LocalCache(max_bytes=100)
+    assert await cache.get_entry("a") == ("value", True)
+    await redis.delete(fresh_key("a"))
+    cache.local = LocalCache(max_bytes=100)
+    assert await cache.get_entry("a") == ("value", False)
+    # stale values are not copied into the local tier
+    assert cache.local.get("a") is None
+
+
+def test_large_values_are_stored_compressed():
+    value = '{"columns":["account_no","amount"],"data":[' + ",".join(['["1000",1.5]'] * 5000) + "]}"
+    encoded = encode_value(value)
+    assert encoded[:5] == b"XQ\x02\x01\x00"
+    assert len(encoded) < len(value) / 10
+    assert decode_value(encoded) == value
+    assert encode_value("small")[:5] == b"XQ\x02\x00\x00"
+    assert decode_value(encode_value(b"XF frame")) == b"XF frame"
+    assert decode_value(b"XQ\x01\x00version one") == "version one"
+    assert decode_value(b"written before the header") == "written before the header"
@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from sqlalchemy import text
+
+from app.services.cache_keys import build_cache_key
+
+SQL = "SELECT sum(amount) FROM sage_intacct__balance_sheet WHERE period_date = :start_date and account_no = :filter_val"
+
+
+def stmt(start_date: datetime, filter_val: str):
+    return text(SQL).bindparams(start_date=start_date, filter_val=filter_val)
+
+
+def test_cache_key_depends_on_bound_values():
+    jan = build_cache_key("tenant", "dbt_acme", "bs_acct", stmt(datetime(2024, 1, 1), "1000"))
+    feb = build_cache_key("tenant", "dbt_acme", "bs_acct", stmt(datetime(2024, 2, 1), "1000"))
+    other_account = build_cache_key("tenant", "dbt_acme", "bs_acct", stmt(datetime(2024, 1, 1), "2000"))
+    assert len({jan, feb, other_account}) == 3
+    assert jan == build_cache_key("tenant", "dbt_acme", "bs_acct", stmt(datetime(2024, 1, 1), "1000"))
+
+
+def test_cache_key_is_namespaced_and_short():
+    key = build_cache_key("tenant", "dbt_acme", "bs_acct", stmt(datetime(2024, 1, 1), "1000"))
+    assert key.startswith("xqf:tenant:dbt_acme:bs_acct:v0:")
+    assert len(key.rsplit(":", 1)[1]) == 32
+    assert SQL not in key
+
+
+def test_cache_key_changes_with_data_version():
+    query = stmt(datetime(2024, 1, 1), "1000")
+    assert (build_cache_key("tenant", "dbt_acme", "bs_acct", query, "1")
+            != build_cache_key("tenant", "dbt_acme", "bs_acct", query, "2"))
@@ -0,0 +1,40 @@
+import asyncio
+
+import pytest
+
+from app.services.cache import LocalCache, TieredCache
+from app.services.cache_lock import get_or_compute
+from tests.services.fake_redis import FakeRedis
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_only_the_lease_holder_computes():
+    redis = FakeRedis()
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        await redis.set("key", "value")
+        return "value"
+
+    results = await asyncio.gather(*(get_or_compute(redis, TieredCache(redis, LocalCache(100)), "key", compute) for _ in range(3)))
+    assert results == ["value"] * 3
+    assert calls == 1
+    assert await redis.get("key:lease") is None
+
+
+async def test_waiters_compute_themselves_when_nothing_is_cached():
+    redis = FakeRedis()
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return None
+
+    await asyncio.gather(get_or_compute(redis, TieredCache(redis, LocalCache(100)), "key", compute), get_or_compute(redis, TieredCache(redis, LocalCache(100)), "key", compute))
+    assert calls == 2
@@ -0,0 +1,57 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app import database
+from app.database import EngineRegistry
+from app.models.fivetranschema import FivetranSchema
+from app.services.cache_warmer import excel_serial, recent_month_ends, warm_batch, warm_tenant_db
+from app.services.custom_function_handler import CustomFunctionHandler
+from app.services.scheduler import get_tenant_scheduler
+from tests.services.fake_redis import FakeRedis
+
+pytestmark = pytest.mark.anyio
+
+
+def test_recent_month_ends_count_back_from_the_last_completed_month():
+    assert recent_month_ends(3, today=date(2024, 3, 15)) == [date(2024, 2, 29), date(2024, 1, 31),
+                                                             date(2023, 12, 31)]
+
+
+async def test_excel_serial_round_trips_through_the_handler():
+    handler = CustomFunctionHandler(None, "PC", [], {}, "tenant_test", None)
+    assert await handler.excel_date_to_datetime(excel_serial(date(2024, 2, 29))) == datetime(2024, 2, 29)
+
+
+def test_warm_batch_covers_active_schemas_only():
+    schemas = {
+        "acme": FivetranSchema(source="sage_intacct", schema_name="acme", is_active=True),
+        "kiwi": FivetranSchema(source="xero", schema_name="kiwi", is_active=True),
+        "gone": FivetranSchema(source="quickbooks", schema_name="gone", is_active=False),
+    }
+    batch = warm_batch(schemas, 2, today=date(2024, 3, 15))
+    operations = [(query["args"]["schema_name"], query["operation"]) for query in batch]
+    assert operations.count(("acme", "trial_balance")) == 2
+    assert operations.count(("kiwi", "profit_and_loss")) == 2
+    # xero has no trial balance model
+    assert ("kiwi", "trial_balance") not in operations
+    assert all(schema_name != "gone" for schema_name, _ in operations)
+    assert len(batch) == 10
+
+
+async def test_warm_job_gives_back_its_engine_lease_and_bulk_slots_when_the_warehouse_is_down(monkeypatch):
+    # nothing listens on port 1, so every warehouse call fails on connect
+    registry = EngineRegistry(max_engines=1, idle_timeout=60,
+                              create=lambda db_string: create_async_engine("postgresql+asyncpg://w:w@127.0.0.1:1/w"))
+    monkeypatch.setattr(database, "warehouse_engines", registry)
+    schemas = {"books": FivetranSchema(source="quickbooks", schema_name="books", is_active=True)}
+    try:
+        result = await warm_tenant_db("tenant_warm_down", schemas, FakeRedis(), FakeRedis(), months=1)
+        assert result["warmed"] == 0 and len(result["failed"]) == 3
+        assert registry.stats()["created"] == 1 and registry.stats()["leased"] == 0
+        bulk = get_tenant_scheduler("tenant_warm_down", "bulk")
+        assert bulk.acquired == 3 and bulk.active == 0
+        assert get_tenant_scheduler("tenant_warm_down", "scalar").acquired == 0
+    finally:
+        await registry.close()
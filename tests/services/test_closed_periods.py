@@ -0,0 +1,137 @@
+from datetime import date, datetime
+
+import pytest
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from app.models.fivetranschema import FivetranSchema
+from app.services.cache import LocalCache
+from app.services.closed_periods import _probes, get_closed_period, reopen_periods, set_closed_through
+from app.services.custom_function_handler import CustomFunctionHandler
+from app.services.data_version import bump_data_version
+from tests.services.fake_redis import FakeRedis
+from tests.services.fake_warehouse import FakeConnectionSession
+
+pytestmark = pytest.mark.anyio
+
+
+def source_lock_date(day):
+    async def lock_date():
+        return day
+    return lock_date
+
+
+async def failing_lock_date():
+    raise ConnectionError("warehouse unavailable")
+
+
+async def test_configured_date_wins_over_the_source_lock_date():
+    redis = FakeRedis()
+    await set_closed_through(redis, "tenant_closed", "dbt_xero", date(2023, 6, 30))
+    closed_through, generation = await get_closed_period(redis, "tenant_closed", "dbt_xero",
+                                                         source_lock_date(date(2023, 3, 31)))
+    assert (closed_through, generation) == (date(2023, 6, 30), "0")
+
+
+async def test_reopen_and_an_earlier_lock_date_start_a_new_generation():
+    redis = FakeRedis()
+    await set_closed_through(redis, "tenant_reopen", "dbt_xero", date(2023, 6, 30))
+    assert await get_closed_period(redis, "tenant_reopen", "dbt_xero", source_lock_date(None)) == (
+        date(2023, 6, 30), "0")
+    await set_closed_through(redis, "tenant_reopen", "dbt_xero", date(2023, 3, 31))
+    assert await get_closed_period(redis, "tenant_reopen", "dbt_xero", source_lock_date(None)) == (
+        date(2023, 3, 31), "1")
+    assert await reopen_periods(redis, "tenant_reopen", "dbt_xero") == 2
+
+
+async def test_closed_period_keys_survive_syncs():
+    redis = FakeRedis()
+    schema = FivetranSchema(source="xero", schema_name="test")
+    handler = CustomFunctionHandler(None, "PC", [], {"test": schema}, "tenant_keys", redis)
+    await set_closed_through(redis, "tenant_keys", "dbt_xero", date(2023, 6, 30))
+    stmt = handler._balance_sheet_statement("xero", "dbt_xero", datetime(2023, 6, 1))
+
+    closed_key, ttl, soft_ttl = await handler._cache_key(stmt, "dbt_xero", "balance_sheet", date(2023, 6, 30))
+    open_key, _, _ = await handler._cache_key(stmt, "dbt_xero", "balance_sheet", date(2023, 7, 31))
+    assert ":vc0:" in closed_key and ":v0:" in open_key
+    assert ttl == soft_ttl > 24 * 60 * 60
+
+    await bump_data_version(redis, "tenant_keys", "dbt_xero")
+    assert (await handler._cache_key(stmt, "dbt_xero", "balance_sheet", date(2023, 6, 30)))[0] == closed_key
+    assert (await handler._cache_key(stmt, "dbt_xero", "balance_sheet", date(2023, 7, 31)))[0] != open_key
+
+
+async def test_failed_lock_date_probe_keeps_the_closed_generation():
+    redis = FakeRedis()
+    assert await get_closed_period(redis, "tenant_blip", "dbt_xero", source_lock_date(date(2023, 6, 30))) == (
+        date(2023, 6, 30), "0")
+    _probes.pop(("tenant_blip", "dbt_xero"))
+    assert await get_closed_period(redis, "tenant_blip", "dbt_xero", failing_lock_date) == (date(2023, 6, 30), "0")
+    _probes.pop(("tenant_blip", "dbt_xero"))
+    assert await get_closed_period(redis, "tenant_blip", "dbt_xero", source_lock_date(date(2023, 6, 30))) == (
+        date(2023, 6, 30), "0")
+
+
+class FailingWarehouse(FakeConnectionSession):
+    """Session factory whose statements all fail with error."""
+
+    engine_key = None
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def async_session_factory(self) -> "FailingWarehouse":
+        return self
+
+    async def __aenter__(self) -> "FailingWarehouse":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    async def execute(self, stmt, execution_options=None):
+        raise self.error
+
+
+def database_error(error_class, sqlstate: str) -> Exception:
+    orig = Exception(sqlstate)
+    orig.sqlstate = sqlstate
+    return error_class("SELECT", {}, orig)
+
+
+async def test_only_a_missing_lock_table_reads_as_no_lock_date():
+    schema = FivetranSchema(source="xero", schema_name="test")
+    missing = CustomFunctionHandler(FailingWarehouse(database_error(ProgrammingError, "42P01")), "PC", [],
+                                    {"test": schema}, "tenant_no_lock_table", FakeRedis(), cache_redis=FakeRedis())
+    assert await missing._source_lock_date(schema) is None
+    failing = CustomFunctionHandler(FailingWarehouse(database_error(OperationalError, "08006")), "PC", [],
+                                    {"test": schema}, "tenant_lock_blip", FakeRedis(), cache_redis=FakeRedis())
+    with pytest.raises(OperationalError):
+        await failing._source_lock_date(schema)
+
+
+class NoLockDateWarehouse(FailingWarehouse):
+    """Counts the lock date queries it answers, always without a date."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.calls = 0
+
+    async def execute(self, stmt, execution_options=None) -> "NoLockDateWarehouse":
+        self.calls += 1
+        return self
+
+    def scalar(self) -> None:
+        return None
+
+
+async def test_missing_lock_date_is_cached_like_a_date():
+    schema = FivetranSchema(source="xero", schema_name="test")
+    warehouse = NoLockDateWarehouse()
+    handler = CustomFunctionHandler(warehouse, "PC", [], {"test": schema}, "tenant_no_lock_date", FakeRedis(),
+                                    cache_redis=FakeRedis())
+    handler.cache.local = LocalCache(max_bytes=1024)
+    assert await handler._source_lock_date(schema) is None
+    # another worker, with nothing in its local cache, finds the answer in Redis
+    handler.cache.local = LocalCache(max_bytes=1024)
+    assert await handler._source_lock_date(schema) is None
+    assert warehouse.calls == 1
@@ -0,0 +1,418 @@
+import asyncio
+import json
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+from app.models.fivetranschema import FivetranSchema
+from app.services.cache import LocalCache, TieredCache, fresh_key
+from app.services.custom_function_handler import CustomFunctionHandler, Response, revalidations
+from app.services.data_version import version_key
+from app.services.frame_codec import encode_frame
+from tests.services.fake_redis import FakeRedis
+from tests.services.fake_warehouse import FakeConnectionSession
+
+pytestmark = pytest.mark.anyio
+
+
+def make_handler(query_batch: list[dict]) -> CustomFunctionHandler:
+    handler = CustomFunctionHandler(None, "PC", query_batch, {}, "tenant_test", None)
+
+    async def sleep_for(seconds: float) -> Response:
+        await asyncio.sleep(seconds)
+        return Response(status="success", type="scalar", value=seconds)
+
+    handler.sleep_for = sleep_for
+    return handler
+
+
+async def test_iter_results_yields_in_completion_order():
+    handler = make_handler([{"operation": "sleep_for", "args": {"seconds": 0.05}},
+                            {"operation": "sleep_for", "args": {"seconds": 0}}])
+    indexes = [index async for index, _ in handler.iter_results()]
+    assert indexes == [1, 0]
+
+
+async def test_execute_returns_results_in_batch_order():
+    handler = make_handler([{"operation": "sleep_for", "args": {"seconds": 0.05}},
+                            {"operation": "sleep_for", "args": {"seconds": 0}}])
+    results = await handler.execute()
+    assert [result.value for result in results] == [0.05, 0]
+
+
+async def test_expired_items_return_errors_while_the_rest_succeed():
+    handler = make_handler([{"operation": "sleep_for", "args": {"seconds": 5}},
+                            {"operation": "sleep_for", "args": {"seconds": 0}}])
+    handler.timeout = 0.05
+    results = await handler.execute()
+    assert results[0].status == "error"
+    assert "timed out" in results[0].value
+    assert results[1] == Response(status="success", type="scalar", value=0)
+
+
+async def test_identical_calls_run_once_and_fan_out():
+    handler = make_handler([{"operation": "sleep_for", "args": {"seconds": "0"}},
+                            {"operation": "sleep_for", "args": {"seconds": 0}}])
+    calls = 0
+    sleep_for = handler.sleep_for
+
+    async def counting_sleep_for(seconds: float) -> Response:
+        nonlocal calls
+        calls += 1
+        return await sleep_for(seconds)
+
+    handler.sleep_for = counting_sleep_for
+    results = await handler.execute()
+    assert calls == 1
+    assert results[0] is results[1]
+
+
+async def cache_balance_sheet(month: int, frame: pd.DataFrame) -> CustomFunctionHandler:
+    """A sage handler, without a warehouse session, whose cache already holds the balance sheet for month."""
+    handler = CustomFunctionHandler(None, "PC", [], {"test": FivetranSchema(source="sage_intacct", schema_name="test")},
+                                    "tenant_test", FakeRedis())
+    handler.cache = TieredCache(FakeRedis(), LocalCache(max_bytes=1024 * 1024))
+    start_date, _ = await handler.period_to_date_range(month, "MTD")
+    stmt = handler._balance_sheet_statement("sage_intacct", "dbt_sage_intacct", start_date)
+    cache_key, _, _ = await handler._cache_key(stmt, "dbt_sage_intacct", "balance_sheet")
+    await handler.cache.set(cache_key, encode_frame(frame), ex=60)
+    return handler
+
+
+async def test_bs_acct_is_answered_from_a_cached_balance_sheet():
+    frame = pd.DataFrame({"account_no": ["1000", "1000", "2000"],
+                          "amount": [Decimal("10.10"), Decimal("0.20"), Decimal("5")]})
+    handler = await cache_balance_sheet(44957, frame)
+    assert await handler.bs_acct("test", 44957, "account_no", "1000") == Response("success", "tabular", "10.30")
+    assert await handler.bs_acct("test", 44957, "account_no", "3000") == Response("success", "tabular", None)
+
+
+async def test_coalesced_scalar_group_is_answered_from_a_cached_balance_sheet():
+    frame = pd.DataFrame({"account_no": ["1000", "2000"], "amount": [Decimal("1.5"), Decimal("-2")]})
+    handler = await cache_balance_sheet(44957, frame)
+    handler.query_batch = [
+        {"operation": "bs_acct",
+         "args": {"schema_name": "test", "month": 44957, "filter_col": "account_no", "filter_val": account}}
+        for account in ("1000", "2000")]
+    results = await handler.execute()
+    assert [result.value for result in results] == ["1.5", "-2"]
+
+
+PnlRow = namedtuple("PnlRow", "period_date account_no account_title account_type book_id category "
+                              "classification currency entry_state total")
+
+
+class FakeResult:
+    def __init__(self, rows: list):
+        self.rows = rows
+
+    def fetchall(self) -> list:
+        return self.rows
+
+    def keys(self) -> list[str]:
+        return list(PnlRow._fields)
+
+
+class FakeWarehouse(FakeConnectionSession):
+    """Answers P&L statements from in-memory rows and records the (start, end) of every one it runs."""
+
+    def __init__(self, rows: list[PnlRow]):
+        self.rows = rows
+        self.ranges = []
+
+    def async_session_factory(self) -> "FakeWarehouse":
+        return self
+
+    async def __aenter__(self) -> "FakeWarehouse":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    async def execute(self, stmt, execution_options=None) -> FakeResult:
+        params = stmt.compile().params
+        if "start" not in params:
+            return FakeResult([])
+        start, end = params["start"].date(), params["end"].date()
+        self.ranges.append((start, end))
+        return FakeResult([row for row in self.rows if start <= row.period_date <= end])
+
+
+def excel_date(day: date) -> int:
+    return day.toordinal() - date(1900, 1, 1).toordinal() + 2
+
+
+async def test_ytd_profit_and_loss_only_queries_months_missing_from_the_cache():
+    rows = [PnlRow(date(2023, month, 1), "4000", "Sales", "revenue", None, None, None, "USD", "Posted",
+                   Decimal(month)) for month in range(1, 13)]
+    warehouse = FakeWarehouse(rows)
+    handler = CustomFunctionHandler(warehouse, "PC", [], {"test": FivetranSchema(source="sage_intacct",
+                                                                                 schema_name="test")},
+                                    "tenant_test", FakeRedis())
+    handler.cache = TieredCache(FakeRedis(), LocalCache(max_bytes=1024 * 1024))
+
+    november = await handler.profit_and_loss("test", excel_date(date(2023, 11, 30)), "YTD")
+    assert warehouse.ranges == [(date(2023, 1, 1), date(2023, 11, 30))]
+    assert len(json.loads(november.value)["data"]) == 11
+
+    december = await handler.profit_and_loss("test", excel_date(date(2023, 12, 31)), "YTD")
+    assert warehouse.ranges[1:] == [(date(2023, 12, 1), date(2023, 12, 31))]
+    assert [row[-1] for row in json.loads(december.value)["data"]] == list(range(1, 13))
+
+    ytd = await handler.pl_acct("test", excel_date(date(2023, 12, 31)), "YTD", "account_no", "4000")
+    assert ytd == Response("success", "tabular", "78")
+    assert len(warehouse.ranges) == 2
+
+
+async def test_statement_fills_for_scalar_cells_run_in_the_bulk_lane():
+    rows = [PnlRow(date(2023, month, 1), "4000", "Sales", "revenue", None, None, None, "USD", "Posted",
+                   Decimal(month)) for month in range(1, 4)]
+    batch = [{"operation": "pl_acct", "args": {"schema_name": "test", "entry_date": excel_date(date(2023, 3, 31)),
+                                               "period": "YTD", "filter_col": "account_no", "filter_val": "4000"}}]
+    handler = CustomFunctionHandler(FakeWarehouse(rows), "PC", batch,
+                                    {"test": FivetranSchema(source="sage_intacct", schema_name="test")},
+                                    "tenant_lanes", FakeRedis(), cache_redis=FakeRedis())
+    lanes = []
+    slot = handler.scheduler.slot
+
+    def recording_slot(lane: str = "scalar"):
+        lanes.append(lane)
+        return slot(lane)
+
+    handler.scheduler.slot = recording_slot
+    results = await handler.execute()
+    assert results[0] == Response("success", "tabular", "6")
+    assert lanes == ["bulk"]
+
+
+class ScalarWarehouse(FakeConnectionSession):
+    """Session factory whose sessions answer every statement with the next value of a counter."""
+
+    engine_key = None
+
+    def __init__(self):
+        self.calls = 0
+
+    def async_session_factory(self) -> "ScalarWarehouse":
+        return self
+
+    async def __aenter__(self) -> "ScalarWarehouse":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    async def execute(self, stmt, execution_options=None) -> "ScalarWarehouse":
+        self.calls += 1
+        return self
+
+    def scalar(self) -> int:
+        return self.calls
+
+
+async def test_stale_values_are_served_while_a_background_refresh_replaces_them():
+    warehouse = ScalarWarehouse()
+    handler = CustomFunctionHandler(warehouse, "PC", [], {}, "tenant_swr", FakeRedis())
+    redis = FakeRedis()
+    handler.cache = TieredCache(redis, LocalCache(max_bytes=1024))
+    stmt = text("SELECT 1")
+    cache_key, _, _ = await handler._cache_key(stmt, "dbt_test", "bs_acct")
+    await handler.cache.set(cache_key, "stale", ex=60)
+    await redis.delete(fresh_key(cache_key))
+    handler.cache.local = LocalCache(max_bytes=1024)
+
+    assert await handler.scalar_query(stmt, "dbt_test", "bs_acct") == "stale"
+    await revalidations[cache_key]
+    # the statement alone, with no search_path or settings round trip ahead of it
+    assert warehouse.calls == 1
+    handler.cache.local = LocalCache(max_bytes=1024)
+    assert await handler.cache.get_entry(cache_key) == ("1", True)
+
+
+class CountingWarehouse(FakeConnectionSession):
+    """Session factory that records how many of its sessions are open at once."""
+
+    def __init__(self):
+        self.open = 0
+        self.max_open = 0
+
+    def async_session_factory(self) -> "CountingWarehouse":
+        return self
+
+    async def __aenter__(self) -> "CountingWarehouse":
+        self.open += 1
+        self.max_open = max(self.max_open, self.open)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.open -= 1
+
+    async def execute(self, stmt, execution_options=None) -> FakeResult:
+        await asyncio.sleep(0.001)
+        return FakeResult([])
+
+
+async def test_sessions_are_held_only_for_a_lane_slot():
+    warehouse = CountingWarehouse()
+    batch = [{"operation": "get_table", "args": {"schema_name": "dbt_test", "table_name": f"table_{i}"}}
+             for i in range(40)]
+    handler = CustomFunctionHandler(warehouse, "PC", batch, {}, "tenant_slots", FakeRedis(),
+                                    cache_redis=FakeRedis())
+    results = await handler.execute()
+    assert all(result.status == "success" for result in results)
+    assert warehouse.open == 0
+    assert warehouse.max_open <= handler.scheduler.lanes["bulk"][0].limit
+
+
+async def test_statements_are_capped_at_the_batch_deadline_on_the_server():
+    warehouse = CountingWarehouse()
+
+    def batch(prefix: str) -> list[dict]:
+        return [{"operation": "get_table", "args": {"schema_name": "dbt_test", "table_name": f"{prefix}_{i}"}}
+                for i in range(5)]
+
+    await CustomFunctionHandler(warehouse, "PC", batch("first"), {}, "tenant_deadline", FakeRedis(),
+                                timeout=30, cache_redis=FakeRedis()).execute()
+    connection = warehouse.wh_connection
+    # set once for the batch; the later items are still within the slack of the cap already on the connection
+    assert connection.settings == [f"SELECT set_config('statement_timeout', "
+                                   f"'{connection.info['statement_timeout']}ms', false) AS set_config_1"]
+    assert 29000 < connection.info["statement_timeout"] <= 30000
+
+    # a batch with a longer budget loosens the cap again
+    await CustomFunctionHandler(warehouse, "PC", batch("second"), {}, "tenant_deadline", FakeRedis(),
+                                timeout=60, cache_redis=FakeRedis()).execute()
+    assert len(connection.settings) == 2
+    assert 59000 < connection.info["statement_timeout"] <= 60000
+
+
+class SlowWarehouse(CountingWarehouse):
+    """Sessions whose statements run until they are cancelled."""
+
+    def __init__(self):
+        super().__init__()
+        self.cancelled = 0
+
+    async def execute(self, stmt, execution_options=None) -> FakeResult:
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return FakeResult([])
+
+
+async def test_timed_out_items_cancel_their_warehouse_query():
+    warehouse = SlowWarehouse()
+    batch = [{"operation": "get_table", "args": {"schema_name": "dbt_test", "table_name": "gl_detail"}}]
+    handler = CustomFunctionHandler(warehouse, "PC", batch, {}, "tenant_cancel", FakeRedis(),
+                                    timeout=0.05, cache_redis=FakeRedis())
+    results = await handler.execute()
+    assert "timed out" in results[0].value
+    await asyncio.sleep(0.01)
+    assert warehouse.cancelled == 1
+    assert warehouse.open == 0
+
+
+class SageWarehouse(CountingWarehouse):
+    """Answers the account-type lookup with an income statement account and records every statement."""
+
+    def __init__(self):
+        super().__init__()
+        self.statements = []
+
+    async def execute(self, stmt, execution_options=None):
+        self.statements.append(str(stmt))
+        return self
+
+    def scalar(self) -> str:
+        return "incomestatement"
+
+    def fetchall(self) -> list:
+        return []
+
+
+async def test_account_type_is_cached_once_for_both_sage_functions():
+    warehouse = SageWarehouse()
+    handler = CustomFunctionHandler(warehouse, "PC", [], {"test": FivetranSchema(source="sage_intacct",
+                                                                                 schema_name="test")},
+                                    "tenant_sage", FakeRedis(), cache_redis=FakeRedis())
+    await handler.sage_acct_bal("test", excel_date(date(2023, 6, 30)), "MTD", "4000")
+    await handler.sage_gl_detail("test", excel_date(date(2023, 6, 30)), "MTD", "4000")
+    assert sum("accounttype" in stmt for stmt in warehouse.statements) == 1
+
+
+class SumWarehouse(CountingWarehouse):
+    """Answers every statement with the numeric total Postgres would return for sum(amount)."""
+
+    def __init__(self, total: Decimal):
+        super().__init__()
+        self.total = total
+
+    async def execute(self, stmt, execution_options=None) -> "SumWarehouse":
+        return self
+
+    def scalar(self) -> Decimal:
+        return self.total
+
+
+async def test_totals_from_a_cached_statement_render_like_the_sql_result():
+    amounts = [Decimal("10.10"), Decimal("0.20"), Decimal("-0.30")]
+    cached = await cache_balance_sheet(44957, pd.DataFrame({"account_no": ["1000"] * 3, "amount": amounts}))
+    uncached = CustomFunctionHandler(SumWarehouse(sum(amounts)), "PC", [],
+                                     {"test": FivetranSchema(source="sage_intacct", schema_name="test")},
+                                     "tenant_sql", FakeRedis(), cache_redis=FakeRedis())
+    from_sql = await uncached.bs_acct("test", 44957, "account_no", "1000")
+    assert from_sql == Response("success", "tabular", "10.00")
+    assert await cached.bs_acct("test", 44957, "account_no", "1000") == from_sql
+
+
+class LatentRedis(FakeRedis):
+    """FakeRedis whose GETs take a round trip, counted per key; like real replies, they land on different loop turns."""
+
+    def __init__(self):
+        super().__init__()
+        self.gets: dict[str, int] = {}
+
+    async def get(self, key: str):
+        self.gets[key] = self.gets.get(key, 0) + 1
+        for _ in range(sum(self.gets.values()) % 5 + 1):
+            await asyncio.sleep(0)
+        return await super().get(key)
+
+
+async def test_cold_batch_probes_the_data_version_once():
+    redis = LatentRedis()
+    batch = [{"operation": "get_table", "args": {"schema_name": "dbt_test", "table_name": f"table_{i}"}}
+             for i in range(30)]
+    handler = CustomFunctionHandler(CountingWarehouse(), "PC", batch, {}, "tenant_cold_version", redis,
+                                    cache_redis=FakeRedis())
+    results = await handler.execute()
+    assert all(result.status == "success" for result in results)
+    assert redis.gets[version_key("tenant_cold_version", "dbt_test")] == 1
+
+
+class MgetCountingRedis(FakeRedis):
+    def __init__(self):
+        super().__init__()
+        self.mgets = 0
+
+    async def mget(self, keys: list[str]):
+        self.mgets += 1
+        return await super().mget(keys)
+
+
+async def test_cold_batch_looks_up_every_cell_in_one_mget():
+    cache_redis = MgetCountingRedis()
+    batch = [{"operation": "get_table", "args": {"schema_name": "dbt_test", "table_name": f"table_{i}"}}
+             for i in range(30)]
+    handler = CustomFunctionHandler(CountingWarehouse(), "PC", batch, {}, "tenant_cold_mget", LatentRedis(),
+                                    cache_redis=cache_redis)
+    handler.cache.local = LocalCache(max_bytes=1024 * 1024)
+    results = await handler.execute()
+    assert all(result.status == "success" for result in results)
+    assert cache_redis.mgets == 1
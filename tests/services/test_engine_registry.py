@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.database import EngineRegistry
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeEngine:
+    def __init__(self, db_string: str):
+        self.db_string = db_string
+        self.disposed = False
+
+    async def dispose(self):
+        self.disposed = True
+
+
+async def test_engines_are_created_once_per_database():
+    registry = EngineRegistry(max_engines=2, idle_timeout=60, create=FakeEngine)
+    factories = await asyncio.gather(*(registry.acquire("db_a") for _ in range(5)))
+    assert len({id(factory) for factory in factories}) == 1
+    assert registry.stats()["created"] == 1
+
+
+async def test_least_recently_used_idle_engine_makes_room():
+    registry = EngineRegistry(max_engines=2, idle_timeout=60, create=FakeEngine)
+    engine_a = (await registry.acquire("db_a")).kw["bind"]
+    await registry.acquire("db_b")
+    await registry.release("db_a")
+    await registry.acquire("db_c")
+    assert engine_a.disposed
+    assert registry.stats()["engines"] == 2
+
+
+async def test_new_tenant_is_not_held_back_by_leased_engines():
+    registry = EngineRegistry(max_engines=1, idle_timeout=60, create=FakeEngine)
+    engine_a = (await registry.acquire("db_a")).kw["bind"]
+    engine_b = (await asyncio.wait_for(registry.acquire("db_b"), timeout=0.1)).kw["bind"]
+    assert not engine_a.disposed and engine_b.db_string == "db_b"
+    # back over the cap once db_a is idle again, so the next new tenant takes its place
+    await registry.release("db_a")
+    await registry.acquire("db_c")
+    assert engine_a.disposed and registry.stats()["engines"] == 2
+
+
+async def test_connections_are_capped_across_every_engine():
+    # nothing listens on port 1, so sessions fail on connect but still take a permit first
+    registry = EngineRegistry(max_engines=2, idle_timeout=60, max_connections=1, wait_timeout=0.01,
+                              create=lambda db_string: create_async_engine("postgresql+asyncpg://w:w@127.0.0.1:1/w"))
+    session_a = (await registry.acquire("db_a"))()
+    session_b = (await registry.acquire("db_b"))()
+    try:
+        with pytest.raises(OSError):
+            await session_a.execute(text("SELECT 1"))
+        assert registry.stats()["connections"] == 1
+        with pytest.raises(TimeoutError, match="no warehouse connection came free within 0.01s"):
+            await session_b.execute(text("SELECT 1"))
+        await session_a.close()
+        assert registry.stats()["connections"] == 0
+        with pytest.raises(OSError):
+            await session_b.execute(text("SELECT 1"))
+        await session_b.close()
+        assert registry.stats()["connections"] == 0
+    finally:
+        await registry.close()
+
+
+class SlowlyDisposedEngine(FakeEngine):
+    def __init__(self, db_string: str):
+        super().__init__(db_string)
+        self.may_finish = asyncio.Event()
+
+    async def dispose(self):
+        await self.may_finish.wait()
+        await super().dispose()
+
+
+async def test_pools_are_torn_down_outside_the_lock():
+    registry = EngineRegistry(max_engines=1, idle_timeout=60, create=SlowlyDisposedEngine)
+    engine_a = (await registry.acquire("db_a")).kw["bind"]
+    await registry.release("db_a")
+    evicting = asyncio.ensure_future(registry.acquire("db_b"))
+    await asyncio.sleep(0.01)
+    assert not evicting.done()
+    # another tenant is served while db_a's pool is still closing
+    await asyncio.wait_for(registry.acquire("db_c"), timeout=0.1)
+    engine_a.may_finish.set()
+    await evicting
+    assert engine_a.disposed
+
+
+async def test_idle_engines_are_reaped():
+    registry = EngineRegistry(max_engines=4, idle_timeout=0, create=FakeEngine)
+    engine_a = (await registry.acquire("db_a")).kw["bind"]
+    await registry.release("db_a")
+    await registry.acquire("db_b")
+    assert engine_a.disposed
+
+
+async def test_leased_engine_is_not_disposed_until_the_lease_ends():
+    registry = EngineRegistry(max_engines=1, idle_timeout=0, create=FakeEngine)
+    engine_a = (await registry.acquire("db_a")).kw["bind"]
+    async with registry.lease("db_a"):
+        await registry.release("db_a")
+        await registry.acquire("db_b")
+        assert not engine_a.disposed
+    await registry.acquire("db_c")
+    assert engine_a.disposed
@@ -0,0 +1,37 @@
+from collections import namedtuple
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
+import pandas as pd
+
+from app.services.frame_codec import decode_frame, encode_frame, frame_to_json
+
+Row = namedtuple("Row", "account_no account_title amount period_date active whenmodified recordno extra mixed")
+
+rows = [
+    Row("1000", "Cash", Decimal("1250.10"), date(2024, 1, 31), True,
+        datetime(2024, 2, 1, 8, 30, tzinfo=timezone.utc), 1, {"a": 1}, Decimal("1")),
+    Row("2000", "Cash", Decimal("-3"), date(2024, 2, 29), False, None, 2, None, 2),
+    Row(None, "Payables", None, None, True, datetime(2024, 2, 3, tzinfo=timezone.utc), 3, [1, 2], None),
+]
+
+
+def test_frame_round_trip_produces_the_same_json():
+    df = pd.DataFrame(rows)
+    assert frame_to_json(decode_frame(encode_frame(df))) == frame_to_json(df)
+
+
+def test_repeated_strings_are_stored_once():
+    df = pd.DataFrame({"account_title": ["Cash", "Payables"] * 500})
+    assert encode_frame(df).count(b"Cash") == 1
+
+
+def test_empty_result_round_trips():
+    df = pd.DataFrame([])
+    assert frame_to_json(decode_frame(encode_frame(df))) == frame_to_json(df)
+
+
+def test_numeric_columns_keep_exact_decimals():
+    decoded = decode_frame(encode_frame(pd.DataFrame(rows)))
+    assert decoded["amount"].tolist() == [Decimal("1250.10"), Decimal("-3"), None]
+    assert str(decoded["amount"][0]) == "1250.10"
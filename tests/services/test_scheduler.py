@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from app.services.scheduler import BatchScheduler, TenantScheduler, operation_lane, tenant_schedulers
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_tenant_scheduler_caps_concurrency():
+    tenant = tenant_schedulers[("tenant_caps", "scalar")] = TenantScheduler(limit=2)
+    batch = BatchScheduler("tenant_caps", limit=10)
+    running = peak = 0
+
+    async def work():
+        nonlocal running, peak
+        async with batch.slot():
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+    await asyncio.gather(*(work() for _ in range(6)))
+    assert peak == 2
+    assert tenant.stats()["acquired"] == 6
+    assert tenant.stats()["active"] == 0
+    assert batch.queue_wait > 0
+
+
+async def test_tenant_scheduler_round_robins_between_batches():
+    tenant = TenantScheduler(limit=1)
+    order = []
+    await tenant.acquire("holder")
+
+    async def work(batch_key: str):
+        await tenant.acquire(batch_key)
+        order.append(batch_key)
+        tenant.release()
+
+    tasks = [asyncio.create_task(work("big")) for _ in range(3)]
+    await asyncio.sleep(0)
+    tasks.append(asyncio.create_task(work("small")))
+    await asyncio.sleep(0)
+    tenant.release()
+    await asyncio.gather(*tasks)
+    assert order == ["big", "small", "big", "big"]
+
+
+async def test_cancelled_waiter_gives_up_its_place():
+    tenant = TenantScheduler(limit=1)
+    await tenant.acquire("holder")
+    waiter = asyncio.create_task(tenant.acquire("batch"))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert tenant.waiting == 0
+    tenant.release()
+    assert tenant.active == 0
+
+
+async def test_lanes_have_separate_budgets():
+    tenant_schedulers[("tenant_lanes", "bulk")] = TenantScheduler(limit=1)
+    batch = BatchScheduler("tenant_lanes", limit=10)
+    async with batch.slot(operation_lane("get_table")):
+        # the bulk lane is full, scalar cells still get a slot straight away
+        async with batch.slot(operation_lane("bs_acct")):
+            assert batch.lanes["scalar"][0].active == 1
+    assert operation_lane("trial_balance") == "bulk"
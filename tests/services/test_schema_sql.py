@@ -0,0 +1,30 @@
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from app.database import schema_options
+from app.models.warehouse import t_xero__balance_sheet_report
+from app.services.schema_sql import qualified_text, quote_schema
+
+
+def test_schema_names_are_folded_and_validated():
+    assert quote_schema("Dbt_Xero") == "dbt_xero"
+    assert quote_schema("select") == '"select"'
+    for name in ("dbt xero", "dbt;drop table x", "", "1dbt", None):
+        with pytest.raises(ValueError):
+            quote_schema(name)
+
+
+def test_text_templates_are_qualified_once_per_schema():
+    sql = "SELECT * FROM {schema}.xero__balance_sheet_report WHERE date_month = :start_date"
+    stmt = qualified_text(sql, "dbt_xero")
+    assert stmt is qualified_text(sql, "dbt_xero")
+    assert str(stmt) == "SELECT * FROM dbt_xero.xero__balance_sheet_report WHERE date_month = :start_date"
+    # binding returns a copy, leaving the cached clause untouched
+    assert stmt.bindparams(start_date="2023-06-01") is not stmt
+
+
+def test_core_statements_are_qualified_by_the_translate_map():
+    stmt = select(t_xero__balance_sheet_report.c.net_amount)
+    compiled = stmt.compile(dialect=postgresql.dialect(), render_schema_translate=True, **schema_options("DBT_Xero"))
+    assert "FROM dbt_xero.xero__balance_sheet_report" in str(compiled)
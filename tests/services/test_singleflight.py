@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from app.services.singleflight import SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_concurrent_calls_share_one_execution():
+    flights = SingleFlight()
+    calls = 0
+
+    async def query():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "rows"
+
+    results = await asyncio.gather(*(flights.do("key", query) for _ in range(5)))
+    assert results == ["rows"] * 5
+    assert calls == 1
+    assert flights.stats() == {"executed": 1, "collapsed": 4, "in_flight": 0}
+
+
+async def test_cancelled_caller_does_not_cancel_the_flight():
+    flights = SingleFlight()
+
+    async def query():
+        await asyncio.sleep(0.02)
+        return "rows"
+
+    leader = asyncio.create_task(flights.do("key", query))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(flights.do("key", query))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await follower == "rows"
+
+
+async def test_flight_is_cancelled_once_every_caller_left():
+    flights = SingleFlight()
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def query():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    callers = [asyncio.create_task(flights.do("key", query)) for _ in range(2)]
+    await started.wait()
+    callers[0].cancel()
+    await asyncio.sleep(0)
+    assert not cancelled.is_set()
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(callers[1], 0.01)
+    await asyncio.sleep(0)
+    assert cancelled.is_set()
+    assert flights.in_flight == 0
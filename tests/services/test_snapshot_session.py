@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+from app.database import DBManager, SnapshotSession, close_warehouse
+from app.models.fivetranschema import FivetranSchema
+from app.services.cache import LocalCache, TieredCache
+from app.services.custom_function_handler import CustomFunctionHandler
+from tests.services.fake_redis import FakeRedis
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeResult:
+    def fetchall(self) -> list:
+        return []
+
+
+class FakeSession:
+    """Records what a snapshot does with its session; statements containing FAIL raise, SLOW ones never finish."""
+
+    def __init__(self, opened: list["FakeSession"]):
+        opened.append(self)
+        self.connection_options = None
+        self.statements = []
+        self.closed = False
+        self.invalidated = False
+
+    async def connection(self, execution_options=None):
+        self.connection_options = execution_options
+
+    async def execute(self, stmt, execution_options=None) -> FakeResult:
+        self.statements.append(str(stmt))
+        if "FAIL" in str(stmt):
+            raise RuntimeError("current transaction is aborted")
+        if "SLOW" in str(stmt):
+            await asyncio.sleep(10)
+        return FakeResult()
+
+    async def close(self):
+        self.closed = True
+
+    async def invalidate(self):
+        self.invalidated = True
+
+
+def session_factory(opened: list[FakeSession]):
+    return lambda: FakeSession(opened)
+
+
+async def test_statements_run_back_to_back_on_one_read_only_snapshot():
+    opened = []
+    snapshot = SnapshotSession(session_factory(opened), "dbt_test")
+    await snapshot.execute(text("SELECT 1"), statement_timeout=500)
+    await snapshot.execute(text("SELECT 2"))
+    assert len(opened) == 1
+    session = opened[0]
+    assert session.connection_options == {"isolation_level": "REPEATABLE READ", "postgresql_readonly": True}
+    assert "set_config" in session.statements[0]
+    assert session.statements[1:] == ["SELECT 1", "SELECT 2"]
+    assert not session.closed
+
+
+async def test_failed_statement_rolls_back_and_the_next_one_gets_a_fresh_snapshot():
+    opened = []
+    snapshot = SnapshotSession(session_factory(opened), "dbt_test")
+    with pytest.raises(RuntimeError):
+        await snapshot.execute(text("SELECT FAIL"))
+    assert opened[0].closed and not opened[0].invalidated
+    await snapshot.execute(text("SELECT 1"))
+    assert len(opened) == 2 and opened[1].statements == ["SELECT 1"]
+
+
+async def test_cancelled_statement_drops_its_connection():
+    opened = []
+    snapshot = SnapshotSession(session_factory(opened), "dbt_test")
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(snapshot.execute(text("SELECT SLOW")), timeout=0.01)
+    assert opened[0].invalidated
+    await snapshot.execute(text("SELECT 1"))
+    assert len(opened) == 2 and opened[1].statements == ["SELECT 1"]
+
+
+async def test_close_ends_every_snapshot_of_the_request():
+    opened = []
+    db_manager = DBManager(session_factory(opened))
+    for schema_ref in ("dbt_a", "dbt_b"):
+        await db_manager.get_snapshot_session(schema_ref).execute(text("SELECT 1"))
+    await close_warehouse(db_manager)
+    assert [session.closed for session in opened] == [True, True]
+    assert all(snapshot.session is None for snapshot in db_manager.snapshot_sessions.values())
+
+
+async def test_pipelined_batches_keep_to_their_own_snapshots():
+    batch = [{"operation": "get_table", "args": {"schema_name": "dbt_test", "table_name": f"table_{i}"}}
+             for i in range(3)]
+    first, second = [], []
+    handlers = [CustomFunctionHandler(DBManager(session_factory(opened)), "PC", batch,
+                                      {"test": FivetranSchema(source="sage_intacct", schema_name="test")},
+                                      "tenant_pipelined", FakeRedis(), pipelined=True)
+                for opened in (first, second)]
+    for handler in handlers:
+        handler.cache = TieredCache(FakeRedis(), LocalCache(max_bytes=1024 * 1024))
+    # the same cells at the same time: neither request waits on a query running on the other's snapshot
+    results = await asyncio.gather(*(handler.execute() for handler in handlers))
+    assert all(result.status == "success" for responses in results for result in responses)
+    assert len(first) == 1 and len(first[0].statements[1:]) == 3
+    assert len(second) == 1 and len(second[0].statements[1:]) == 3
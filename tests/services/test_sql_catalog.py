@@ -0,0 +1,25 @@
+import pytest
+
+from app.services.sql_catalog import catalog_sql, catalog_statement
+
+
+def test_catalog_statements_are_built_once_per_schema():
+    stmt = catalog_statement("balance_sheet", "xero", "dbt_xero")
+    assert stmt is catalog_statement("balance_sheet", "xero", "dbt_xero")
+    assert stmt is not catalog_statement("balance_sheet", "xero", "dbt_other")
+    assert "FROM dbt_xero.xero__balance_sheet_report" in str(stmt)
+
+
+def test_column_variants_take_plain_column_names_only():
+    sql = catalog_sql("bs_acct", "sage_intacct", "column", "account_no")
+    assert "and account_no = :filter_val" in sql
+    for column in (None, "account_no = 1 or 1", "Account_No"):
+        with pytest.raises(ValueError):
+            catalog_sql("bs_acct", "sage_intacct", "column", column)
+
+
+def test_unknown_templates_are_unsupported():
+    with pytest.raises(ValueError, match="unsupported source"):
+        catalog_sql("trial_balance", "xero")
+    with pytest.raises(ValueError, match="unsupported source"):
+        catalog_sql("employee", "netsuite", "active")
@@ -0,0 +1,52 @@
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app.models.fivetranschema import FivetranSchema
+from app.services.tenant_context import get_tenant_context, invalidate_tenant_context
+from tests.services.fake_redis import FakeRedis
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeAppSession:
+    """Counts the transactions opened to load xadmin_fivetranschema."""
+
+    def __init__(self, schemas: list[FivetranSchema]):
+        self.schemas = schemas
+        self.transactions = 0
+        self.in_transaction = False
+
+    @asynccontextmanager
+    async def begin(self):
+        self.transactions += 1
+        self.in_transaction = True
+        try:
+            yield
+        finally:
+            self.in_transaction = False
+
+    async def execute(self, stmt) -> "FakeAppSession":
+        return self
+
+    def scalars(self) -> "FakeAppSession":
+        return self
+
+    def all(self) -> list[FivetranSchema]:
+        return self.schemas
+
+
+async def test_tenant_context_is_loaded_once_until_invalidated():
+    redis = FakeRedis()
+    db_session = FakeAppSession([FivetranSchema(source="xero", schema_name="kiwi")])
+    context = await get_tenant_context(db_session, redis, 41, "tenant_41")
+    assert list(context.schemas) == ["kiwi"] and context.tenant_db == "tenant_41"
+    # the app-DB transaction is over before the caller starts warehouse work
+    assert not db_session.in_transaction
+
+    assert await get_tenant_context(db_session, redis, 41, "tenant_41") is context
+    assert db_session.transactions == 1
+
+    await invalidate_tenant_context(redis, 41)
+    assert await get_tenant_context(db_session, redis, 41, "tenant_41") is not context
+    assert db_session.transactions == 2